@@ -0,0 +1,78 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the startup time of the Toolbox command-line tools.
+
+Each measurement runs a fresh interpreter, so it includes everything a short
+invocation pays before doing any work: the interpreter itself, the imports and
+the parsing of the tool arguments."""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+from os import path
+
+# module constants
+TARGETS = {
+    "python": "pass",
+    "import-cli": "import twtoolbox.cli",
+    "import-package": "import twtoolbox",
+    "ids-convert": "import sys; sys.argv = ['tt', 'ids', 'convert', '--help']; "
+                   "from twtoolbox.cli import tt; tt()",
+    "tweets-get-timeline": "import sys; sys.argv = ['tt', 'tweets', 'get-timeline', '--help']; "
+                           "from twtoolbox.cli import tt; tt()",
+    "streaming-get-sample": "import sys; sys.argv = ['tt', 'streaming', 'get-sample', '--help']; "
+                            "from twtoolbox.cli import tt; tt()",
+}
+
+def measure(code, repeat):
+    """Return the wall-clock seconds of running the given code in fresh interpreters."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [path.dirname(path.dirname(path.abspath(__file__))), os.environ.get("PYTHONPATH", "")]))
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            started = time.time()
+            subprocess.call([sys.executable, "-c", code], env=env, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - started)
+    return sorted(timings)
+
+def main():
+    """Run the startup benchmark for every target and report the timings."""
+    parser = ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("targets", metavar="TARGET", nargs="*", default=sorted(TARGETS),
+                        help="targets to measure (default: all): %s" % ", ".join(sorted(TARGETS)))
+    parser.add_argument("--repeat", metavar="N", type=int, default=10,
+                        help="number of runs per target (the median is reported)")
+    parser.add_argument("--json", action="store_true", help="report results in JSON format")
+    args = parser.parse_args()
+    results = []
+    for target in args.targets:
+        timings = measure(TARGETS[target], args.repeat)
+        results.append({"target": target, "median_ms": timings[len(timings) // 2] * 1000,
+                        "min_ms": timings[0] * 1000})
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("%-22s %10s %10s" % ("target", "median (ms)", "min (ms)"))
+    for result in results:
+        print("%-22s %11.1f %10.1f" % (result["target"], result["median_ms"], result["min_ms"]))
+
+if __name__ == "__main__":
+    main()
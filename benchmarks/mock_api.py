@@ -0,0 +1,289 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-in for the Twitter REST and Streaming APIs, for offline benchmarking.
+
+Emulated endpoints: statuses/lookup, users/lookup, followers/ids, friends/ids,
+statuses/user_timeline, search/tweets, users/search, statuses/sample, statuses/filter and
+statuses/firehose (plus oauth2/token). Cursors, max_id pagination and rate limit
+headers behave like the real API, with configurable sizes and latency."""
+
+from __future__ import print_function
+import json
+import time
+from argparse import ArgumentParser
+from threading import Lock, Thread
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
+    from socketserver import ThreadingMixIn  # pylint: disable=import-error
+    from urllib.parse import urlparse, parse_qs  # pylint: disable=import-error
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
+    from SocketServer import ThreadingMixIn  # pylint: disable=import-error
+    from urlparse import urlparse, parse_qs  # pylint: disable=import-error
+
+# module constants
+RATE_LIMIT_WINDOW = 15 * 60
+MAX_TWEET_ID = 10 ** 15
+USER_FIELDS = {
+    "id": -222, "id_str": "-222", "name": "Benchmark User", "screen_name": "user-222",
+    "location": "San Francisco, CA", "description": "A user of the mock Twitter API.",
+    "url": "https://t.co/8IkCzCDr19", "protected": False, "followers_count": 6133636,
+    "friends_count": 12, "listed_count": 12936, "created_at": "Wed May 23 06:01:13 +0000 2007",
+    "favourites_count": 31, "utc_offset": None, "time_zone": None, "geo_enabled": False,
+    "verified": False, "statuses_count": 3656, "lang": "en",
+    "profile_image_url_https": "https://pbs.twimg.com/profile_images/0/normal.png",
+}
+TWEET_FIELDS = {
+    "created_at": "Mon Jan 01 00:00:00 +0000 2018",
+    "id": -111, "id_str": "-111",
+    "text": "Sample Tweet text with a #hashtag, a @mention and a link https://t.co/abcdefghij",
+    "source": "<a href=\"http://twitter.com\" rel=\"nofollow\">Twitter Web Client</a>",
+    "truncated": False, "in_reply_to_status_id": None, "in_reply_to_user_id": None,
+    "in_reply_to_screen_name": None, "user": USER_FIELDS,
+    "geo": None, "coordinates": None, "place": None, "contributors": None,
+    "is_quote_status": False, "quote_count": 0, "reply_count": 0, "retweet_count": 0,
+    "favorite_count": 0,
+    "entities": {
+        "hashtags": [{"text": "hashtag", "indices": [25, 33]}],
+        "urls": [{"url": "https://t.co/abcdefghij", "expanded_url": "https://example.com",
+                  "display_url": "example.com", "indices": [57, 80]}],
+        "user_mentions": [{"screen_name": "mention", "name": "Mention", "id": 1, "id_str": "1",
+                           "indices": [37, 45]}],
+        "symbols": [],
+    },
+    "favorited": False, "retweeted": False, "filter_level": "low", "lang": "en",
+}
+
+def _make_template(fields):
+    template = json.dumps(fields, separators=(",", ":")).replace("%", "%%")
+    for sentinel, name in (("111", "id"), ("222", "user_id")):
+        template = template.replace("-" + sentinel, "%%(%s)d" % name)
+    return template
+
+TWEET_TEMPLATE = _make_template(TWEET_FIELDS)
+USER_TEMPLATE = _make_template(USER_FIELDS)
+
+def make_tweet(tweet_id, user_id=1):
+    """Make the JSON representation of a Tweet."""
+    return TWEET_TEMPLATE % {"id": tweet_id, "user_id": user_id}
+
+def make_user(user_id):
+    """Make the JSON representation of a user."""
+    return USER_TEMPLATE % {"id": user_id, "user_id": user_id}
+
+def _get_id_list(value):
+    return [int(el) for el in value.split(",") if el.strip()] if value else []
+
+class MockTwitterServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server emulating the Twitter APIs."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, size=1000, latency=0.0, rate_limit=100000):
+        HTTPServer.__init__(self, address, MockTwitterHandler)
+        self.size = size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.num_requests = 0
+        self._budgets = {}
+        self._lock = Lock()
+
+    def consume(self, resource, token):
+        """Consume one request of the rate limit budget of an endpoint and a credential."""
+        with self._lock:
+            self.num_requests += 1
+            now = time.time()
+            remaining, reset = self._budgets.get((resource, token), (self.rate_limit, 0))
+            if reset <= now:
+                remaining, reset = self.rate_limit, int(now) + RATE_LIMIT_WINDOW
+            remaining = max(remaining - 1, -1)
+            self._budgets[(resource, token)] = (remaining, reset)
+            return remaining, reset
+
+    @property
+    def url(self):
+        """Base URL of the server."""
+        return "http://%s:%d" % self.server_address[:2]
+
+class MockTwitterHandler(BaseHTTPRequestHandler):
+    """Request handler emulating the Twitter APIs."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def _get_params(self):
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > 0:
+            body = self.rfile.read(length).decode("utf-8")
+            params.update((key, values[-1]) for key, values in parse_qs(body).items())
+        return url.path, params
+
+    def _send(self, status, data, headers=None):
+        data = data.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle GET requests."""
+        self._handle()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Handle POST requests."""
+        self._handle()
+
+    def _handle(self):
+        path, params = self._get_params()
+        if path == "/oauth2/token":
+            self._send(200, '{"token_type":"bearer","access_token":"MOCK"}')
+            return
+        if path.startswith("/1.1/statuses/") and path.rsplit("/", 1)[1] in (
+                "sample.json", "filter.json", "firehose.json"):
+            self._stream()
+            return
+        handler = REST_ENDPOINTS.get(path)
+        if handler is None:
+            self._send(404, '{"errors":[{"code":34,"message":"Sorry, that page does not exist."}]}')
+            return
+        resource = path[len("/1.1/"):-len(".json")]
+        remaining, reset = self.server.consume(resource, self.headers.get("Authorization"))
+        headers = {"x-rate-limit-limit": self.server.rate_limit,
+                   "x-rate-limit-remaining": max(remaining, 0), "x-rate-limit-reset": reset}
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if remaining < 0:
+            self._send(429, '{"errors":[{"code":88,"message":"Rate limit exceeded"}]}', headers)
+            return
+        self._send(200, handler(self.server, params), headers)
+
+    def _stream(self):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        tweet_id = 1
+        try:
+            while True:
+                data = ("%s\r\n" % make_tweet(tweet_id)).encode("utf-8")
+                self.wfile.write(b"%d\r\n%s" % (len(data), data))
+                tweet_id += 1
+        except (IOError, OSError):
+            pass
+
+def _lookup_statuses(_, params):
+    return "[%s]" % ",".join(make_tweet(_id) for _id in _get_id_list(params.get("id")))
+
+def _lookup_users(_, params):
+    user_ids = _get_id_list(params.get("user_id"))
+    for screen_name in (params.get("screen_name") or "").split(","):
+        if screen_name.startswith("user") and screen_name[4:].isdigit():
+            user_ids.append(int(screen_name[4:]))
+    return "[%s]" % ",".join(make_user(_id) for _id in user_ids)
+
+def _get_ids(server, params):
+    count = int(params.get("count", 5000))
+    cursor = max(int(params.get("cursor", -1)), 0)
+    ids = list(range(cursor + 1, min(cursor + count, server.size) + 1))
+    next_cursor = cursor + count if cursor + count < server.size else 0
+    return json.dumps({"ids": ids, "next_cursor": next_cursor, "next_cursor_str": str(next_cursor),
+                       "previous_cursor": 0, "previous_cursor_str": "0"})
+
+def _gen_page_ids(server, params):
+    count = int(params.get("count", 20))
+    max_id = int(params.get("max_id", MAX_TWEET_ID))
+    since_id = int(params.get("since_id", 0))
+    first_id = MAX_TWEET_ID - server.size + 1
+    top_id = min(max_id, MAX_TWEET_ID)
+    return range(top_id, max(top_id - count, since_id, first_id - 1), -1)
+
+def _get_timeline(server, params):
+    user_id = int(params.get("user_id", 1))
+    return "[%s]" % ",".join(make_tweet(_id, user_id) for _id in _gen_page_ids(server, params))
+
+def _search_tweets(server, params):
+    return '{"statuses":[%s],"search_metadata":{"count":%d,"query":%s}}' % (
+        ",".join(make_tweet(_id) for _id in _gen_page_ids(server, params)),
+        int(params.get("count", 15)), json.dumps(params.get("q", "")))
+
+def _search_users(server, params):
+    # page-numbered, with the last user of each page repeated as the first of the next one
+    count = int(params.get("count", 20))
+    first_id = max(int(params.get("page", 1)) - 1, 0) * (count - 1) + 1
+    user_ids = range(first_id, min(first_id + count, server.size + 1))
+    return "[%s]" % ",".join(make_user(_id) for _id in user_ids)
+
+def _get_rate_limit_status(server, _):
+    resources = {}
+    for path in REST_ENDPOINTS:
+        resource = path[len("/1.1/"):-len(".json")]
+        family = resources.setdefault(resource.split("/")[0], {})
+        family["/" + resource] = {"limit": server.rate_limit, "remaining": server.rate_limit,
+                                  "reset": int(time.time()) + RATE_LIMIT_WINDOW}
+    return json.dumps({"resources": resources})
+
+REST_ENDPOINTS = {
+    "/1.1/statuses/lookup.json": _lookup_statuses,
+    "/1.1/users/lookup.json": _lookup_users,
+    "/1.1/followers/ids.json": _get_ids,
+    "/1.1/friends/ids.json": _get_ids,
+    "/1.1/statuses/user_timeline.json": _get_timeline,
+    "/1.1/search/tweets.json": _search_tweets,
+    "/1.1/users/search.json": _search_users,
+    "/1.1/application/rate_limit_status.json": _get_rate_limit_status,
+}
+
+def start_server(port=0, size=1000, latency=0.0, rate_limit=100000):
+    """Start a mock Twitter API server in a background thread."""
+    server = MockTwitterServer(("127.0.0.1", port), size=size, latency=latency,
+                               rate_limit=rate_limit)
+    thread = Thread(target=server.serve_forever, name="mock-twitter-api")
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    """Run a mock Twitter API server in the foreground."""
+    parser = ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--size", type=int, default=1000,
+                        help="number of ids/Tweets per followers, friends, timeline or search")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay in seconds before each response")
+    parser.add_argument("--rate-limit", type=int, default=100000,
+                        help="requests allowed per endpoint and credential every 15 minutes")
+    args = parser.parse_args()
+    server = MockTwitterServer(("127.0.0.1", args.port), size=args.size,
+                               latency=args.latency, rate_limit=args.rate_limit)
+    print("mock Twitter API listening on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the Toolbox against a local mock Twitter API server.
+
+Each scenario runs in its own process (so peak memory is measured per scenario)
+using the real Toolbox code paths, with all requests to api.twitter.com and
+stream.twitter.com redirected to the mock server."""
+
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+from os import path
+import mock_api
+
+# module constants
+SCENARIOS = [
+    "tweets-hydrate", "users-hydrate", "users-followers", "users-friends", "tweets-timeline",
+    "tweets-search", "users-search", "streaming-sample", "streaming-filter", "bulk-timeline",
+]
+CONFIG_TEMPLATE = """[twitter]
+consumer_key=MOCK
+consumer_secret=MOCK
+access_token_key=MOCK
+access_token_secret=MOCK
+
+[streaming]
+raw = %(raw)s
+queue_size = %(queue_size)d
+
+[search]
+limit = 0
+
+[timeline]
+limit = 0
+
+[followers]
+limit = 0
+
+[search_users]
+concurrency = %(concurrency)d
+
+[friends]
+limit = 0
+
+[sample]
+limit = %(size)d
+
+[filter]
+limit = %(size)d
+"""
+TWITTER_URL_PATTERN = re.compile(r"^https://(api|stream)\.twitter\.com")
+
+class CountingWriter(object):
+    """Writer that discards data, counting the objects (lines) and bytes written."""
+
+    def __init__(self):
+        self.num_objects = 0
+        self.num_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def write(self, data):
+        """Count the written data."""
+        self.num_objects += data.count("\n")
+        self.num_bytes += len(data)
+
+    def flush(self):
+        """Nothing to flush."""
+
+def _redirect_requests(base_url):
+    import requests
+    original_request = requests.Session.request
+    def _request(self, method, url, *args, **kwargs):
+        return original_request(self, method, TWITTER_URL_PATTERN.sub(base_url, url),
+                                *args, **kwargs)
+    requests.Session.request = _request
+
+def _count_lines(output_dir):
+    num_lines = 0
+    for filename in os.listdir(output_dir):
+        if filename.endswith(".ckpt"):
+            continue
+        with open(path.join(output_dir, filename), "rb") as reader:
+            num_lines += sum(1 for _ in reader)
+    return num_lines
+
+def _run(scenario, args):
+    from twtoolbox import streaming, tweets, users
+    writer = CountingWriter()
+    ids = range(1, args.size + 1)
+    if scenario == "tweets-hydrate":
+        tweets.get_hydrated(writer, ids)
+    elif scenario == "users-hydrate":
+        users.get_hydrated(writer, user_ids=ids)
+    elif scenario == "users-followers":
+        users.get_followers(writer, user_id=1)
+    elif scenario == "users-friends":
+        users.get_friends(writer, user_id=1)
+    elif scenario == "tweets-timeline":
+        tweets.get_timeline(writer, user_id=1)
+    elif scenario == "tweets-search":
+        tweets.search(writer, "benchmark")
+    elif scenario == "users-search":
+        users.search(writer, "benchmark")
+    elif scenario == "streaming-sample":
+        streaming.get_sample(writer)
+    elif scenario == "streaming-filter":
+        streaming.get_filter(writer, track=["benchmark"])
+    elif scenario == "bulk-timeline":
+        output_dir = tempfile.mkdtemp(prefix="twtoolbox-bench-")
+        try:
+            tweets.bulk_get_timeline(output_dir, user_ids=range(1, args.bulk_users + 1),
+                                     workers=args.workers)
+            writer.num_objects = _count_lines(output_dir)
+        finally:
+            shutil.rmtree(output_dir)
+    else:
+        raise ValueError("unknown scenario: %s" % scenario)
+    return writer.num_objects
+
+def run_scenario(scenario, args):
+    """Run a scenario in the current process and return its measurements."""
+    _redirect_requests(args.server)
+    import twtoolbox  # pylint: disable=unused-variable
+    initial_usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    num_objects = _run(scenario, args)
+    elapsed = time.time() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {
+        "scenario": scenario, "objects": num_objects, "seconds": elapsed,
+        "objects_per_second": num_objects / elapsed if elapsed > 0 else 0.0,
+        "cpu_seconds": (usage.ru_utime + usage.ru_stime -
+                        initial_usage.ru_utime - initial_usage.ru_stime),
+        "peak_rss_mb": peak_rss / 1024.0 ** 2,
+    }
+
+def _spawn_scenario(scenario, args, server, home):
+    env = dict(os.environ, HOME=home, PYTHONPATH=os.pathsep.join(
+        [path.dirname(path.dirname(path.abspath(__file__))), os.environ.get("PYTHONPATH", "")]))
+    command = [sys.executable, path.abspath(__file__), "--scenario", scenario,
+               "--server", server.url, "--size", str(args.size),
+               "--bulk-users", str(args.bulk_users), "--workers", str(args.workers)]
+    output = subprocess.check_output(command, env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode("utf-8").strip().split("\n")[-1])
+
+def main():
+    """Run the benchmark scenarios and report their throughput and resource usage."""
+    parser = ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("scenarios", metavar="SCENARIO", nargs="*", default=SCENARIOS,
+                        help="scenarios to run (default: all): %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--size", type=int, default=10000,
+                        help="number of objects per scenario (per user for bulk scenarios)")
+    parser.add_argument("--bulk-users", type=int, default=10,
+                        help="number of users for bulk scenarios")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of workers for bulk scenarios")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay in seconds before each mock API response")
+    parser.add_argument("--rate-limit", type=int, default=100000,
+                        help="mock API requests allowed per endpoint every 15 minutes")
+    parser.add_argument("--raw", action="store_true",
+                        help="use the raw pass-through mode for streaming scenarios")
+    parser.add_argument("--queue-size", type=int, default=0,
+                        help="use a write queue of this size for streaming scenarios")
+    parser.add_argument("--concurrency", type=int, default=5,
+                        help="concurrent page requests for the users-search scenario")
+    parser.add_argument("--json", action="store_true", help="report results in JSON format")
+    parser.add_argument("--scenario", help=SUPPRESS)
+    parser.add_argument("--server", help=SUPPRESS)
+    args = parser.parse_args()
+
+    # child process: run a single scenario and report it
+    if args.scenario is not None:
+        print(json.dumps(run_scenario(args.scenario, args)))
+        return
+
+    # parent process: start the mock server and run every scenario in a child process
+    server = mock_api.start_server(size=args.size, latency=args.latency,
+                                   rate_limit=args.rate_limit)
+    home = tempfile.mkdtemp(prefix="twtoolbox-bench-home-")
+    try:
+        with open(path.join(home, ".twtoolbox.cfg"), "w") as writer:
+            writer.write(CONFIG_TEMPLATE % {"raw": "true" if args.raw else "false",
+                                            "queue_size": args.queue_size, "size": args.size,
+                                            "concurrency": args.concurrency})
+        results = [_spawn_scenario(scenario, args, server, home) for scenario in args.scenarios]
+    finally:
+        shutil.rmtree(home)
+        server.shutdown()
+
+    # report results
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("%-18s %10s %10s %12s %10s %10s" % (
+        "scenario", "objects", "seconds", "objects/sec", "cpu (s)", "rss (MB)"))
+    for result in results:
+        print("%-18s %10d %10.2f %12.1f %10.2f %10.1f" % (
+            result["scenario"], result["objects"], result["seconds"],
+            result["objects_per_second"], result["cpu_seconds"], result["peak_rss_mb"]))
+
+if __name__ == "__main__":
+    main()
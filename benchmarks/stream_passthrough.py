@@ -0,0 +1,89 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the per-Tweet CPU cost of the streaming pass-through listener."""
+
+from __future__ import print_function
+import json
+import time
+from argparse import ArgumentParser
+from tweepy import API
+from twtoolbox.streaming import PassThroughStreamListener
+
+# module constants
+TWEET = {
+    "created_at": "Mon Jan 01 00:00:00 +0000 2018",
+    "id": 947235015343202304,
+    "id_str": "947235015343202304",
+    "text": "Sample Tweet text with a #hashtag, a @mention and a link https://t.co/abcdefghij",
+    "source": "<a href=\"http://twitter.com\" rel=\"nofollow\">Twitter Web Client</a>",
+    "truncated": False,
+    "in_reply_to_status_id": None,
+    "in_reply_to_user_id": None,
+    "in_reply_to_screen_name": None,
+    "user": {
+        "id": 6253282, "id_str": "6253282", "name": "Twitter API", "screen_name": "TwitterAPI",
+        "location": "San Francisco, CA", "description": "The Real Twitter API.",
+        "url": "https://t.co/8IkCzCDr19", "protected": False, "followers_count": 6133636,
+        "friends_count": 12, "listed_count": 12936, "created_at": "Wed May 23 06:01:13 +0000 2007",
+        "favourites_count": 31, "utc_offset": None, "time_zone": None, "geo_enabled": False,
+        "verified": True, "statuses_count": 3656, "lang": "en",
+        "profile_image_url_https": "https://pbs.twimg.com/profile_images/0/normal.png",
+    },
+    "geo": None, "coordinates": None, "place": None, "contributors": None,
+    "is_quote_status": False, "quote_count": 0, "reply_count": 0, "retweet_count": 0,
+    "favorite_count": 0,
+    "entities": {
+        "hashtags": [{"text": "hashtag", "indices": [25, 33]}],
+        "urls": [{"url": "https://t.co/abcdefghij", "expanded_url": "https://example.com",
+                  "display_url": "example.com", "indices": [57, 80]}],
+        "user_mentions": [{"screen_name": "mention", "name": "Mention", "id": 1, "id_str": "1",
+                           "indices": [37, 45]}],
+        "symbols": [],
+    },
+    "favorited": False, "retweeted": False, "filter_level": "low", "lang": "en",
+    "timestamp_ms": "1514764800000",
+}
+
+class NullWriter(object):
+    """Writer that discards all data."""
+
+    def write(self, data):
+        """Discard data."""
+
+def benchmark(raw, num_tweets):
+    """Return the CPU seconds per Tweet spent by the listener in the given mode."""
+    raw_data = "%s\r\n" % json.dumps(TWEET, separators=(",", ":"))
+    listener = PassThroughStreamListener(NullWriter(), raw=raw, api=API())
+    start = time.process_time() if hasattr(time, "process_time") else time.clock()
+    for _ in range(num_tweets):
+        listener.on_data(raw_data)
+    end = time.process_time() if hasattr(time, "process_time") else time.clock()
+    return (end - start) / num_tweets
+
+def main():
+    """Run the benchmark for the parsed and raw modes."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--tweets", metavar="N", type=int, default=100000,
+                        help="number of Tweets to pass through in each mode")
+    args = parser.parse_args()
+    parsed = benchmark(False, args.tweets)
+    raw = benchmark(True, args.tweets)
+    print("parsed: %.2f us/tweet" % (parsed * 1e6))
+    print("raw:    %.2f us/tweet" % (raw * 1e6))
+    print("speedup: %.1fx" % (parsed / raw))
+
+if __name__ == "__main__":
+    main()
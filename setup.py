@@ -19,7 +19,8 @@ def _read_file(filename):
 def _gen_console_scripts():
     with open(path.join("twtoolbox", "cli.py")) as reader:
         cli_tree = ast.parse(reader.read())
-    return ["%s = twtoolbox.cli:%s" % (fn.name.replace("_", "-"), fn.name)
+    return ["tt = twtoolbox.cli:tt"] + \
+           ["%s = twtoolbox.cli:%s" % (fn.name.replace("_", "-"), fn.name)
             for fn in cli_tree.body if isinstance(fn, ast.FunctionDef) and
             fn.name.startswith('tt_')]
 
@@ -30,9 +31,12 @@ setup(
     url=URL, download_url=DOWNLOAD_URL,
     requires=["tweepy", "colorlog"],
     install_requires=["tweepy", "colorlog"],
+    extras_require={"zstd": ["zstandard"], "async": ["aiohttp"]},
     provides=["twtoolbox"],
     keywords=["twitter", "api", "cli", "toolbox"],
-    classifiers=["Environment :: Console"],
+    classifiers=["Environment :: Console", "Programming Language :: Python :: 3",
+                 "Programming Language :: Python :: 3 :: Only"],
+    python_requires=">=3.4",
     license="Apache-2.0",
     platforms=["all"],
     long_description=_read_file("README.md"),
@@ -15,6 +15,18 @@
 
 """Twitter Toolbox for Python package."""
 
-from . import streaming
-from . import tweets
-from . import users
+import sys
+from importlib import import_module
+
+# module constants
+SUBMODULES = ("ids", "shards", "streaming", "tweets", "users", "writers")
+
+# submodules are imported on first access, so tools only load the subsystem they use
+def __getattr__(name):
+    if name in SUBMODULES:
+        return import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+if sys.version_info < (3, 7):  # no module __getattr__ support (PEP 562)
+    for _name in SUBMODULES:
+        import_module("." + _name, __name__)  # also sets the package attribute
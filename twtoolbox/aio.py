@@ -0,0 +1,387 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asynchronous (asyncio) Twitter REST API backend module.
+
+Requires Python 3.6+ and the optional 'aiohttp' package."""
+
+import asyncio
+import logging
+import json
+import time
+from urllib.parse import urlencode
+try:
+    import aiohttp  # pylint: disable=import-error
+except ImportError:
+    aiohttp = None  # pylint: disable=invalid-name
+from oauthlib.oauth1 import Client as OAuth1Client
+from tweepy import TweepError, RateLimitError
+from .helpers import init_logger, read_config, get_credential_sections
+from .helpers import ensure_at_least_one, ensure_only_one, gen_chunks, log_tweep_error
+from .helpers import RATE_LIMITS, RATE_LIMIT_MARGIN, METRICS, PROFILER
+from .cache import open_cache
+from .tweets import LOOKUP_STATUSES_PER_REQUEST, TIMELINE_COUNT, SEARCH_COUNT
+from .users import LOOKUP_USERS_PER_REQUEST, FOLLOWERS_IDS_COUNT, FRIENDS_IDS_COUNT
+
+# module constants
+API_HOST = "https://api.twitter.com"
+API_VERSION = "1.1"
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+# module logging
+LOGGER = logging.getLogger(__name__)
+init_logger(LOGGER)
+
+def _get_api_error(status, data):
+    try:
+        error = json.loads(data)["errors"][0]
+        reason, api_code = error["message"], error["code"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        reason, api_code = data, None
+    reason = "Twitter error response: status code = %d, %s" % (status, reason)
+    if status == 429 or api_code == 88:
+        return RateLimitError(reason, api_code=api_code)
+    return TweepError(reason, api_code=api_code)
+
+class _BearerSigner(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, token):
+        self.token = token
+
+    def sign(self, method, url, params):
+        """Get the URL, headers and body of a request authenticated with a bearer token."""
+        headers = {"Authorization": "Bearer %s" % self.token}
+        if method == "POST":
+            headers["Content-Type"] = FORM_CONTENT_TYPE
+            return url, headers, urlencode(params)
+        return "%s?%s" % (url, urlencode(params)), headers, None
+
+class _OAuthSigner(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, config, section):
+        self.client = OAuth1Client(
+            config.get(section, "consumer_key"),
+            client_secret=config.get(section, "consumer_secret"),
+            resource_owner_key=config.get(section, "access_token_key"),
+            resource_owner_secret=config.get(section, "access_token_secret"))
+
+    def sign(self, method, url, params):
+        """Get the URL, headers and body of a request signed with OAuth."""
+        if method == "POST":
+            return self.client.sign(url, http_method=method, body=urlencode(params),
+                                    headers={"Content-Type": FORM_CONTENT_TYPE})
+        return self.client.sign("%s?%s" % (url, urlencode(params)), http_method=method)
+
+class AsyncAPIPool(object):
+    """Pool of API credentials sharing an HTTP session, sending requests asynchronously.
+
+    Like the threaded API pools, each request uses the credential with most remaining
+    rate limit budget, and only waits when all of them are exhausted."""
+
+    def __init__(self, session, signers, tracker=None):
+        self.session = session
+        self.signers = signers
+        self.keys = list(signers)
+        self.tracker = tracker if tracker is not None else RATE_LIMITS
+
+    async def _reserve(self, resource):
+        while True:
+            key, wait_time = self.tracker.reserve(self.keys, resource)
+            if key is not None:
+                return key
+            LOGGER.warning("rate limit reached for %s on all %d credential(s), "
+                           "sleeping for %d seconds", resource, len(self.keys), wait_time)
+            METRICS.inc("rate_limit_sleeps_total", endpoint=resource)
+            METRICS.inc("rate_limit_sleep_seconds_total", wait_time + RATE_LIMIT_MARGIN,
+                        endpoint=resource)
+            await asyncio.sleep(wait_time + RATE_LIMIT_MARGIN)
+
+    async def request(self, resource, params, method="GET"):
+        """Send a request to an API endpoint family and return the decoded JSON response."""
+        url = "%s/%s/%s.json" % (API_HOST, API_VERSION, resource)
+        params = dict((name, value) for name, value in params.items() if value is not None)
+        while True:
+            key = await self._reserve(resource)
+            url_signed, headers, body = self.signers[key].sign(method, url, params)
+            started = time.time()
+            try:
+                async with self.session.request(method, url_signed, headers=headers,
+                                                data=body) as response:
+                    status = response.status
+                    data = await response.text()
+                    self.tracker.update(key, resource, response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as excp:
+                # wrapped like Tweepy does, so the callers handle them as any other API error
+                METRICS.inc("request_errors_total", endpoint=resource)
+                raise TweepError("Failed to send request: %s" % (str(excp) or type(excp).__name__))
+            finally:
+                METRICS.inc("requests_total", endpoint=resource)
+                METRICS.observe("request_seconds", time.time() - started, endpoint=resource)
+            if status == 200:
+                return json.loads(data)
+            METRICS.inc("request_errors_total", endpoint=resource)
+            error = _get_api_error(status, data)
+            if not isinstance(error, RateLimitError):
+                raise error
+            self.tracker.exhaust(key, resource, response.headers.get("x-rate-limit-reset"))
+            if len(self.keys) > 1:
+                LOGGER.info("rate limit reached for %s, switching credentials", resource)
+
+    async def refresh_budgets(self):
+        """Refresh the rate limit budgets of all the pooled credentials from the API.
+
+        This avoids sending a burst of concurrent requests to a single credential before
+        its budgets are known from response headers."""
+        async def _refresh(key):
+            url, headers, _ = self.signers[key].sign(
+                "GET", "%s/%s/application/rate_limit_status.json" % (API_HOST, API_VERSION), {})
+            async with self.session.get(url, headers=headers) as response:
+                data = await response.text()
+                if response.status != 200:
+                    raise _get_api_error(response.status, data)
+            self.tracker.update_from_status(key, json.loads(data))
+        for key, result in zip(self.keys, await asyncio.gather(
+                *[_refresh(key) for key in self.keys], return_exceptions=True)):
+            if isinstance(result, Exception):
+                LOGGER.warning("could not refresh rate limit budgets of %s: %s", key, result)
+
+    async def gen_cursor_pages(self, resource, params, key):
+        """Generate the pages of results of a cursored endpoint."""
+        cursor = -1
+        while cursor != 0:
+            page = await self.request(resource, dict(params, cursor=cursor))
+            yield page[key]
+            cursor = page["next_cursor"]
+
+    async def gen_max_id_pages(self, resource, params, key=None):
+        """Generate the pages of results of an endpoint paginated by Tweet ids (max_id)."""
+        max_id = None
+        while True:
+            page = await self.request(resource, dict(params, max_id=max_id))
+            page = page[key] if key is not None else page
+            if not page:
+                return
+            yield page
+            max_id = min(obj["id"] for obj in page) - 1
+
+async def _get_bearer_token(session, config, section):
+    consumer_key = config.get(section, "consumer_key")
+    async with session.post("%s/oauth2/token" % API_HOST, data={
+            "grant_type": "client_credentials"}, auth=aiohttp.BasicAuth(
+                consumer_key, config.get(section, "consumer_secret"))) as response:
+        data = await response.text()
+        if response.status != 200:
+            raise _get_api_error(response.status, data)
+    return "app:%s" % consumer_key, _BearerSigner(json.loads(data)["access_token"])
+
+async def _run_bounded(coroutines, concurrency):
+    total, pending = 0, set()
+    try:
+        for coroutine in coroutines:
+            pending.add(asyncio.ensure_future(coroutine))
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                total += sum(task.result() for task in done)
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            total += sum(task.result() for task in done)
+    finally:
+        # if a task failed, do not leave the others running unattended
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    return total
+
+def _write_obj(writer, obj, callback=None):
+    with PROFILER.timer("serialize"):
+        data = json.dumps(obj, separators=(",", ":"))
+    with PROFILER.timer("write"):
+        writer.write("%s\n" % data)
+    METRICS.inc("objects_written_total", kind="objects")
+    METRICS.inc("bytes_written_total", len(data) + 1)
+    if callback is not None:
+        callback(_CachedObject(obj), data)
+
+class _CachedObject(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, obj):
+        self.id = obj["id"]  # pylint: disable=invalid-name
+        if "screen_name" in obj:
+            self.screen_name = obj["screen_name"]
+
+class AsyncAPI(object):
+    """Asynchronous Twitter REST API client with connection pooling for all credentials.
+
+    Must be used as an asynchronous context manager. Operations can run concurrently
+    (e.g. using asyncio.gather()), bounded by the configured number of connections."""
+
+    def __init__(self, config=None, concurrency=None):
+        if aiohttp is None:
+            raise ValueError("the asynchronous backend requires the 'aiohttp' package")
+        self.config = config if config is not None else read_config()
+        self.concurrency = concurrency if concurrency is not None else \
+                           self.config.getint("async", "concurrency")
+        self.session = None
+        self.app_auth = None
+        self.oauth = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.config.getint("async", "timeout")))
+        sections = get_credential_sections(self.config)
+        self.oauth = AsyncAPIPool(self.session, dict(
+            ("user:%s" % self.config.get(section, "access_token_key"),
+             _OAuthSigner(self.config, section)) for section in sections))
+        self.app_auth = AsyncAPIPool(self.session, dict(await asyncio.gather(*[
+            _get_bearer_token(self.session, self.config, section) for section in sections])))
+        await asyncio.gather(self.oauth.refresh_budgets(), self.app_auth.refresh_budgets())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def _lookup(self, writer, resource, params, cache=None):
+        try:
+            objs = await self.oauth.request(resource, params, method="POST")
+        except TweepError as err:
+            log_tweep_error(LOGGER, err)
+            return 0
+        for obj in objs:
+            _write_obj(writer, obj, cache.put if cache is not None else None)
+        return len(objs)
+
+    async def get_hydrated_tweets(self, writer, tweet_ids):
+        """Get hydrated Tweet-objects from a list of Tweet ids."""
+        LOGGER.info("get_hydrated_tweets() starting")
+        cache = open_cache(self.config, "tweets")
+        if cache is not None:
+            tweet_ids = cache.gen_misses(writer, tweet_ids)
+        try:
+            num_tweets = await _run_bounded((
+                self._lookup(writer, "statuses/lookup", {
+                    "id": ",".join(str(_id) for _id in chunk[0])}, cache)
+                for chunk in gen_chunks(tweet_ids, size=LOOKUP_STATUSES_PER_REQUEST)),
+                                            self.concurrency)
+        finally:
+            if cache is not None:
+                cache.close()
+        if cache is not None:
+            num_tweets += cache.num_hits
+        LOGGER.info("downloaded %d Tweet(s)", num_tweets)
+        LOGGER.info("get_hydrated_tweets() finished")
+        return num_tweets
+
+    async def get_hydrated_users(self, writer, user_ids=None, screen_names=None):
+        """Get hydrated Twitter User-objects from a list of user ids and/or screen names."""
+        LOGGER.info("get_hydrated_users() starting")
+        ensure_at_least_one(user_ids=user_ids, screen_names=screen_names)
+        user_ids = user_ids if user_ids else []
+        screen_names = screen_names if screen_names else []
+        cache = open_cache(self.config, "users")
+        if cache is not None:
+            user_ids = cache.gen_misses(writer, user_ids)
+            screen_names = cache.gen_misses(writer, screen_names, by_screen_name=True)
+        try:
+            num_users = await _run_bounded((
+                self._lookup(writer, "users/lookup", {
+                    "user_id": ",".join(str(_id) for _id in chunk[0]) or None,
+                    "screen_name": ",".join(chunk[1]) or None}, cache)
+                for chunk in gen_chunks(user_ids, screen_names, size=LOOKUP_USERS_PER_REQUEST)),
+                                           self.concurrency)
+        finally:
+            if cache is not None:
+                cache.close()
+        if cache is not None:
+            num_users += cache.num_hits
+        LOGGER.info("downloaded %d user(s)", num_users)
+        LOGGER.info("get_hydrated_users() finished")
+        return num_users
+
+    async def _write_pages(self, writer, pages, limit=0):
+        num_objs = 0
+        try:
+            async for page in pages:
+                for obj in page:
+                    _write_obj(writer, obj)
+                    num_objs += 1
+                    if num_objs == limit:
+                        return num_objs
+        except TweepError as err:
+            log_tweep_error(LOGGER, err)
+        return num_objs
+
+    async def get_timeline(self, writer, user_id=None, screen_name=None, since_id=0):
+        """Get hydrated Tweet-objects from a user timeline."""
+        LOGGER.info("get_timeline() starting")
+        ensure_only_one(user_id=user_id, screen_name=screen_name)
+        params = {"count": TIMELINE_COUNT, "user_id": user_id, "screen_name": screen_name,
+                  "since_id": since_id if since_id > 0 else None}
+        num_tweets = await self._write_pages(
+            writer, self.app_auth.gen_max_id_pages("statuses/user_timeline", params),
+            limit=self.config.getint("timeline", "limit"))
+        LOGGER.info("downloaded %d Tweet(s)", num_tweets)
+        LOGGER.info("get_timeline() finished")
+        return num_tweets
+
+    async def search(self, writer, query, since_id=0):
+        """Get hydrated Tweet-objects using the Search API."""
+        LOGGER.info("search() starting")
+        params = {"q": query, "count": SEARCH_COUNT, "result_type": "recent",
+                  "since_id": since_id if since_id > 0 else None}
+        num_tweets = await self._write_pages(
+            writer, self.app_auth.gen_max_id_pages("search/tweets", params, key="statuses"),
+            limit=self.config.getint("search", "limit"))
+        LOGGER.info("downloaded %d Tweet(s)", num_tweets)
+        LOGGER.info("search() finished")
+        return num_tweets
+
+    async def _get_ids(self, writer, resource, count, limit, user_id, screen_name):  # pylint: disable=too-many-arguments
+        ensure_only_one(user_id=user_id, screen_name=screen_name)
+        params = {"count": count, "user_id": user_id, "screen_name": screen_name}
+        write_id = getattr(writer, "write_id", None)
+        num_ids = 0
+        try:
+            async for page in self.app_auth.gen_cursor_pages(resource, params, "ids"):
+                for _id in page:
+                    if write_id is not None:
+                        write_id(_id)
+                    else:
+                        writer.write("%d\n" % _id)
+                    METRICS.inc("objects_written_total", kind="ids")
+                    num_ids += 1
+                    if num_ids == limit:
+                        return num_ids
+        except TweepError as err:
+            log_tweep_error(LOGGER, err)
+        return num_ids
+
+    async def get_followers(self, writer, user_id=None, screen_name=None):
+        """Get the ids of the followers for a Twitter user id or screen name."""
+        LOGGER.info("get_followers() starting")
+        num_ids = await self._get_ids(writer, "followers/ids", FOLLOWERS_IDS_COUNT,
+                                      self.config.getint("followers", "limit"),
+                                      user_id, screen_name)
+        LOGGER.info("downloaded %d follower id(s)", num_ids)
+        LOGGER.info("get_followers() finished")
+        return num_ids
+
+    async def get_friends(self, writer, user_id=None, screen_name=None):
+        """Get the ids of the friends for a Twitter user id or screen name."""
+        LOGGER.info("get_friends() starting")
+        num_ids = await self._get_ids(writer, "friends/ids", FRIENDS_IDS_COUNT,
+                                      self.config.getint("friends", "limit"),
+                                      user_id, screen_name)
+        LOGGER.info("downloaded %d friend id(s)", num_ids)
+        LOGGER.info("get_friends() finished")
+        return num_ids
@@ -0,0 +1,158 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of hydrated Twitter objects module."""
+
+import sqlite3
+import time
+from os import path
+
+# module constants
+LOOKUP_BATCH_SIZE = 100
+COMMIT_INTERVAL = 1000
+BYTES_PER_MEGABYTE = 1024 * 1024
+
+class HydrationCache(object):
+    """On-disk cache of hydrated Twitter objects keyed by id, with TTL and size limit."""
+
+    def __init__(self, filename, table, ttl=0, max_size=0):
+        self.table = table
+        self.ttl = ttl
+        self.max_size = max_size
+        self.num_hits = 0
+        self.num_misses = 0
+        self._num_pending = 0
+        self._size_delta = 0
+        self._conn = sqlite3.connect(filename, timeout=60)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, screen_name TEXT, "
+            "fetched REAL NOT NULL, size INTEGER NOT NULL, data TEXT NOT NULL)" % table)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS %s_screen_name ON %s (screen_name)" % (table, table))
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS %s_fetched ON %s (fetched)" % (table, table))
+
+        # running total size of the cached objects, so evicting does not scan the whole table
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS %s_size (total INTEGER NOT NULL)" % table)
+        self._conn.execute(
+            "INSERT INTO %s_size (total) SELECT COALESCE(SUM(size), 0) FROM %s "
+            "WHERE NOT EXISTS (SELECT 1 FROM %s_size)" % (table, table, table))
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_min_fetched(self):
+        return time.time() - self.ttl if self.ttl > 0 else 0
+
+    def _lookup(self, column, keys):
+        query = "SELECT %s, data FROM %s WHERE fetched >= ? AND %s IN (%s)" % (
+            column, self.table, column, ",".join("?" * len(keys)))
+        return dict(self._conn.execute(query, [self._get_min_fetched()] + keys))
+
+    def gen_misses(self, writer, keys, by_screen_name=False):
+        """Write the cached objects for the given ids (or screen names) and generate the misses."""
+        column = "screen_name" if by_screen_name else "id"
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) == LOOKUP_BATCH_SIZE:
+                for miss in self._write_hits(writer, column, batch):
+                    yield miss
+                batch = []
+        if batch:
+            for miss in self._write_hits(writer, column, batch):
+                yield miss
+
+    def _write_hits(self, writer, column, batch):
+        lookup_keys = [key.lower() for key in batch] if column == "screen_name" else batch
+        cached = self._lookup(column, lookup_keys)
+        misses = []
+        for key, lookup_key in zip(batch, lookup_keys):
+            if lookup_key in cached:
+                writer.write("%s\n" % cached[lookup_key])
+                self.num_hits += 1
+            else:
+                misses.append(key)
+        self.num_misses += len(misses)
+        return misses
+
+    def put(self, obj, data):
+        """Store a freshly hydrated Twitter object with its JSON serialization."""
+        screen_name = getattr(obj, "screen_name", None)
+        replaced = self._conn.execute(
+            "SELECT size FROM %s WHERE id = ?" % self.table, (obj.id,)).fetchone()
+        self._size_delta += len(data) - (replaced[0] if replaced else 0)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO %s (id, screen_name, fetched, size, data) "
+            "VALUES (?, ?, ?, ?, ?)" % self.table,
+            (obj.id, screen_name.lower() if screen_name else None, time.time(), len(data), data))
+        self._num_pending += 1
+        if self._num_pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def evict(self):
+        """Evict expired objects and the oldest objects exceeding the size limit."""
+        if self.ttl > 0:
+            min_fetched = self._get_min_fetched()
+            self._size_delta -= self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM %s WHERE fetched < ?" % self.table,
+                (min_fetched,)).fetchone()[0]
+            self._conn.execute("DELETE FROM %s WHERE fetched < ?" % self.table, (min_fetched,))
+        if self.max_size > 0:
+            excess_size = self._update_size() - self.max_size
+            if excess_size > 0:
+                evicted_ids = []
+                for obj_id, size in self._conn.execute(
+                        "SELECT id, size FROM %s ORDER BY fetched" % self.table):
+                    if excess_size <= 0:
+                        break
+                    evicted_ids.append((obj_id,))
+                    excess_size -= size
+                    self._size_delta -= size
+                self._conn.executemany("DELETE FROM %s WHERE id = ?" % self.table, evicted_ids)
+        self._update_size()
+
+    def _update_size(self):
+        # apply the pending size changes to the running total and return it
+        if self._size_delta:
+            self._conn.execute("UPDATE %s_size SET total = total + ?" % self.table,
+                               (self._size_delta,))
+            self._size_delta = 0
+        return self._conn.execute("SELECT total FROM %s_size" % self.table).fetchone()[0]
+
+    def commit(self):
+        """Evict objects if needed and commit the pending changes to disk."""
+        self.evict()
+        self._conn.commit()
+        self._num_pending = 0
+
+    def close(self):
+        """Commit the pending changes and close the cache."""
+        self.commit()
+        self._conn.close()
+
+def open_cache(config, table):
+    """Open the hydration cache configured in the [cache] section, if any."""
+    filename = config.get("cache", "filename")
+    if not filename:
+        return None
+    return HydrationCache(path.expanduser(filename), table,
+                          ttl=config.getint("cache", "ttl"),
+                          max_size=config.getint("cache", "max_size") * BYTES_PER_MEGABYTE)
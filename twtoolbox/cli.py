@@ -16,42 +16,127 @@
 """Command-line Interface module."""
 
 import sys
+import atexit
 import logging
 from argparse import ArgumentParser
 from contextlib import closing
-from .helpers import init_logger, gen_basic_config
-from . import streaming
-from . import tweets
-from . import users
-
-try:
-    input = raw_input  # pylint: disable=redefined-builtin, invalid-name
-except NameError:
-    pass
+from os import path
+from .helpers import init_logger, gen_basic_config, start_metrics_server, start_metrics_file
+from .helpers import start_profiler
+from .ids import open_binary_ids_writer, text_to_binary, binary_to_text
+from .writers import COMPRESSION_EXTENSIONS, SYNC_INTERVAL, SYNC_RECORDS
+from .writers import open_writer, truncate_torn_tail, RotatingWriter
 
 # module logging
 LOGGER = logging.getLogger(__name__)
 init_logger(LOGGER)
 
+# options for submitting jobs to a daemon instead of running them (see --daemon)
+_SUBMIT = {}
+
+# options for group-committing the output to disk (see --durable)
+_DURABLE = {}
+
 def _get_writer(filename, resume=False):
     if filename is None:
         if "__exit__" in dir(sys.stdout):
             return sys.stdout
         return closing(sys.stdout)
-    return open(filename, "a" if resume else "w")
+    if resume and path.exists(filename) and truncate_torn_tail(filename):
+        LOGGER.warning("truncated torn trailing record of: %s", filename)
+    return open_writer(filename, append=resume, **_DURABLE)
+
+def _add_durable_arguments(parser):
+    group = parser.add_argument_group("durability")
+    group.add_argument("--durable", action="store_true", required=False,
+                       help="group-commit the output to disk, syncing it in batches")
+    group.add_argument("--sync-interval", metavar="SECONDS", type=float, default=SYNC_INTERVAL,
+                       help="maximum time between syncs in durable mode (default: %(default)s)")
+    group.add_argument("--sync-records", metavar="N", type=int, default=SYNC_RECORDS,
+                       help="maximum records between syncs in durable mode (default: %(default)s)")
+
+def _add_rotation_arguments(parser):
+    parser.add_argument("--rotate-size", metavar="BYTES", type=int, default=0,
+                        help="rotate the output file after writing this amount of data")
+    parser.add_argument("--rotate-interval", metavar="SECONDS", type=int, default=0,
+                        help="rotate the output file every this number of seconds (clock-aligned)")
+
+def _get_stream_writer(parser, args):
+    if args.rotate_size > 0 or args.rotate_interval > 0:
+        if args.output_file is None:
+            parser.error("an output file (pattern) is required for rotating the output")
+        return RotatingWriter(args.output_file, max_size=args.rotate_size,
+                              interval=args.rotate_interval, **_DURABLE)
+    return _get_writer(args.output_file, args.resume)
+
+def _gen_strings(filename):
+    with open(filename) if filename != "-" else closing(sys.stdin) as reader:
+        for line in reader:
+            line = line.strip()
+            if line and not line.startswith("##"):
+                yield line
 
 def _read_strings(filename):
     if filename is None:
         return []
-    with open(filename) as reader:
-        return [line.strip() for line in reader if not line.startswith("##")]
+    return _gen_strings(filename)
 
 def _read_integers(filename):
-    return [int(line) for line in _read_strings(filename)]
+    if filename is None:
+        return []
+    return (int(line) for line in _gen_strings(filename))
+
+def _get_ids_writer(filename, resume=False, binary=False, sort=False):
+    if binary:
+        return open_binary_ids_writer(filename, append=resume, sort=sort)
+    return _get_writer(filename, resume)
+
+def _add_ids_format_arguments(parser):
+    parser.add_argument("--binary", action="store_true", required=False,
+                        help="write ids in compact binary format instead of plain text")
+    parser.add_argument("--sort", action="store_true", required=False,
+                        help="sort the ids in binary format (kept in memory until finished)")
+
+def _add_shards_argument(parser):
+    parser.add_argument("--shards", metavar="N", type=int, default=0,
+                        help="pack the outputs into N shard files instead of one file per input")
+
+def _add_daemon_arguments(parser):
+    parser.add_argument("--daemon", metavar="SOCKET", nargs="?", const="", required=False,
+                        help="submit the job to a running tt-daemon (default socket from config)")
+
+def _parse_args(parser):
+    group = parser.add_argument_group("metrics")
+    group.add_argument("--metrics-port", metavar="PORT", type=int, required=False,
+                       help="serve metrics in Prometheus format on this local HTTP port")
+    group.add_argument("--metrics-file", metavar="FILE", required=False,
+                       help="periodically write metrics to this JSON stats file")
+    group = parser.add_argument_group("profiling")
+    group.add_argument("--profile", action="store_true", required=False,
+                       help="record the wall time per phase and print a summary table at exit")
+    group.add_argument("--profile-file", metavar="FILE", required=False,
+                       help="also write a cProfile dump of all threads to this file")
+    args = parser.parse_args()
+    if args.profile or args.profile_file is not None:
+        atexit.register(start_profiler(args.profile_file).stop)
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
+    if args.metrics_file is not None:
+        atexit.register(start_metrics_file(args.metrics_file).stop)
+    if getattr(args, "daemon", None) is not None:
+        _SUBMIT.update(socket_path=args.daemon)
+    if getattr(args, "durable", False):
+        _DURABLE.update(durable=True, sync_interval=args.sync_interval,
+                        sync_records=args.sync_records)
+    return args
 
 def _safe_call(func, *args, **kwargs):
     try:
-        func(*args, **kwargs)
+        if _SUBMIT:
+            from .daemon import submit_job
+            submit_job(func, *args, socket_path=_SUBMIT["socket_path"], **kwargs)
+        else:
+            func(*args, **kwargs)
     except Exception as excp:  # pylint: disable=broad-except
         LOGGER.error(excp)
 
@@ -71,17 +156,21 @@ def tt_config():
 
 def tt_streaming_get_sample():
     """Interface to streaming.get_sample()"""
+    from . import streaming
     parser = ArgumentParser(description=streaming.get_sample.__doc__)
     parser.add_argument("--output-file", metavar="FILE", required=False,
-                        help="file for output hydrated Tweets (JSON format)")
+                        help="file (strftime pattern if rotating) for output Tweets (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
-    with _get_writer(args.output_file, args.resume) as writer:
+    _add_durable_arguments(parser)
+    _add_rotation_arguments(parser)
+    args = _parse_args(parser)
+    with _get_stream_writer(parser, args) as writer:
         _safe_call(streaming.get_sample, writer)
 
 def tt_streaming_get_filter():
     """Interface to streaming.get_filter()"""
+    from . import streaming
     parser = ArgumentParser(description=streaming.get_filter.__doc__)
     parser.add_argument("--follow", metavar="USER_ID", type=int, nargs='+',
                         help="list of user ids to follow")
@@ -89,46 +178,57 @@ def tt_streaming_get_filter():
                         help="list of Twitter terms to track")
     parser.add_argument("--locations", metavar="COORDINATE", type=float, nargs='+',
                         help="list of coordinates to filter by locations")
+    parser.add_argument("--shards", metavar="N", type=int, default=1,
+                        help="number of parallel connections to split the filter across")
     parser.add_argument("--output-file", metavar="FILE", required=False,
-                        help="file for output hydrated Tweets (JSON format)")
+                        help="file (strftime pattern if rotating) for output Tweets (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
+    _add_durable_arguments(parser)
+    _add_rotation_arguments(parser)
+    args = _parse_args(parser)
     if args.locations and (len(args.locations) % 4) != 0:
         parser.error("you must give exactly four coordinates per bounding box")
-    with _get_writer(args.output_file, args.resume) as writer:
-        _safe_call(streaming.get_filter, writer,
-                   follow=args.follow, track=args.track, locations=args.locations)
+    with _get_stream_writer(parser, args) as writer:
+        _safe_call(streaming.get_filter, writer, follow=args.follow, track=args.track,
+                   locations=args.locations, shards=args.shards)
 
 def tt_streaming_get_firehose():
     """Interface to streaming.firehose()"""
+    from . import streaming
     parser = ArgumentParser(description=streaming.get_firehose.__doc__)
     parser.add_argument("--output-file", metavar="FILE", required=False,
-                        help="file for output hydrated Tweets (JSON format)")
+                        help="file (strftime pattern if rotating) for output Tweets (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
-    with _get_writer(args.output_file, args.resume) as writer:
+    _add_durable_arguments(parser)
+    _add_rotation_arguments(parser)
+    args = _parse_args(parser)
+    with _get_stream_writer(parser, args) as writer:
         _safe_call(streaming.get_firehose, writer)
 
 ### Tools for Tweets ###
 
 def tt_tweets_get_hydrated():
     """Interface to tweets.get_hydrated()"""
+    from . import tweets
     parser = ArgumentParser(description=tweets.get_hydrated.__doc__)
     parser.add_argument("--tweet-ids", metavar="FILE", required=True,
-                        help="file with input Tweet ids (text format)")
+                        help="file with input Tweet ids (text format, - for standard input)")
     parser.add_argument("--output-file", metavar="FILE",
                         help="file for output hydrated Tweets (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
+    _add_durable_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
     tweet_ids = _read_integers(args.tweet_ids)
     with _get_writer(args.output_file, args.resume) as writer:
         _safe_call(tweets.get_hydrated, writer, tweet_ids)
 
 def tt_tweets_get_retweets():
     """Interface to tweets.get_retweets()"""
+    from . import tweets
     parser = ArgumentParser(description=tweets.get_retweets.__doc__)
     parser.add_argument("--tweet-id", metavar="TWEET_ID", type=int, required=True,
                         help="Tweet Id to get the retweets for")
@@ -136,12 +236,15 @@ def tt_tweets_get_retweets():
                         help="file for output hydrated Retweets (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
+    _add_durable_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
     with _get_writer(args.output_file, args.resume) as writer:
         _safe_call(tweets.get_retweets, writer, args.tweet_id)
 
 def tt_tweets_get_timeline():
     """Interface to tweets.get_timeline()"""
+    from . import tweets
     parser = ArgumentParser(description=tweets.get_timeline.__doc__)
     parser.add_argument("--user-id", metavar="USER_ID", type=int,
                         help="User Id to get the timeline for")
@@ -151,13 +254,16 @@ def tt_tweets_get_timeline():
                         help="file for output hydrated Tweets (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
+    _add_durable_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
     with _get_writer(args.output_file, args.resume) as writer:
         _safe_call(tweets.get_timeline, writer,
                    user_id=args.user_id, screen_name=args.screen_name)
 
 def tt_tweets_search():
     """Interface to tweets.search()"""
+    from . import tweets
     parser = ArgumentParser(description=tweets.search.__doc__)
     parser.add_argument("--query", metavar="QUERY", required=True,
                         help="query for searching Tweets")
@@ -165,7 +271,9 @@ def tt_tweets_search():
                         help="file for output hydrated Tweets (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
+    _add_durable_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
     with _get_writer(args.output_file, args.resume) as writer:
         _safe_call(tweets.search, writer, args.query)
 
@@ -173,16 +281,19 @@ def tt_tweets_search():
 
 def tt_users_get_hydrated():
     """Interface to users.get_hydrated()"""
+    from . import users
     parser = ArgumentParser(description=users.get_hydrated.__doc__)
     parser.add_argument("--user-ids", metavar="FILE",
-                        help="file with input user ids (text format)")
+                        help="file with input user ids (text format, - for standard input)")
     parser.add_argument("--screen-names", metavar="FILE",
-                        help="file with input user screen names (text format)")
+                        help="file with input user screen names (text format, - for standard input)")
     parser.add_argument("--output-file", metavar="FILE",
                         help="file for output hydrated users (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
+    _add_durable_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
     user_ids = _read_integers(args.user_ids)
     screen_names = _read_strings(args.screen_names)
     with _get_writer(args.output_file, args.resume) as writer:
@@ -190,38 +301,47 @@ def tt_users_get_hydrated():
 
 def tt_users_get_followers():
     """Interface to users.get_followers()"""
+    from . import users
     parser = ArgumentParser(description=users.get_followers.__doc__)
     parser.add_argument("--user-id", metavar="USER_ID", type=int,
                         help="User Id to get the followers for")
     parser.add_argument("--screen-name", metavar="SCREEN_NAME",
                         help="User screen name to get the followers for")
     parser.add_argument("--output-file", metavar="FILE",
-                        help="file for output follower ids (text format)")
+                        help="file for output follower ids (text or binary format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
-    with _get_writer(args.output_file, args.resume) as writer:
+    _add_durable_arguments(parser)
+    _add_ids_format_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
+    with _get_ids_writer(args.output_file, args.resume, args.binary, args.sort) as writer:
         _safe_call(users.get_followers, writer,
                    user_id=args.user_id, screen_name=args.screen_name)
 
 def tt_users_get_friends():
     """Interface to users.get_friends()"""
+    from . import users
     parser = ArgumentParser(description=users.get_friends.__doc__)
     parser.add_argument("--user-id", metavar="USER_ID", type=int,
                         help="User Id to get the friends for")
     parser.add_argument("--screen-name", metavar="SCREEN_NAME",
                         help="User screen name to get the friends for")
     parser.add_argument("--output-file", metavar="FILE",
-                        help="file for output friend ids (text format)")
+                        help="file for output friend ids (text or binary format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
-    with _get_writer(args.output_file, args.resume) as writer:
+    _add_durable_arguments(parser)
+    _add_ids_format_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
+    with _get_ids_writer(args.output_file, args.resume, args.binary, args.sort) as writer:
         _safe_call(users.get_friends, writer,
                    user_id=args.user_id, screen_name=args.screen_name)
 
 def tt_users_search():
     """Interface to users.search()"""
+    from . import users
     parser = ArgumentParser(description=users.search.__doc__)
     parser.add_argument("--query", metavar="QUERY", required=True,
                         help="query for searching users")
@@ -229,83 +349,251 @@ def tt_users_search():
                         help="file for output hydrated users (JSON format)")
     parser.add_argument("--resume", action="store_true", required=False,
                         help="resume writing to the output file instead of truncating")
-    args = parser.parse_args()
+    _add_durable_arguments(parser)
+    _add_daemon_arguments(parser)
+    args = _parse_args(parser)
     with _get_writer(args.output_file, args.resume) as writer:
         _safe_call(users.search, writer, args.query)
 
+def tt_bulk_run():
+    """Interface to planner.run_manifest()"""
+    from . import planner
+    parser = ArgumentParser(description=planner.run_manifest.__doc__)
+    parser.add_argument("--manifest", metavar="FILE", required=True,
+                        help="file with the bulk jobs to run (JSON format)")
+    parser.add_argument("--dry-run", action="store_true", required=False,
+                        help="only estimate the requests and time needed by the jobs")
+    args = _parse_args(parser)
+    _safe_call(planner.run_manifest, args.manifest, dry_run=args.dry_run)
+
+def tt_users_crawl():
+    """Interface to users.crawl()"""
+    from . import users
+    parser = ArgumentParser(description=users.crawl.__doc__)
+    parser.add_argument("--user-ids", metavar="FILE", required=True,
+                        help="file with input seed user ids (text format, - for standard input)")
+    parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
+                        help="directory for output follower/friend ids and crawl checkpoints")
+    parser.add_argument("--relations", choices=users.CRAWL_RELATIONS, nargs="+",
+                        default=["followers"], help="relations to crawl (default: followers)")
+    parser.add_argument("--depth", metavar="N", type=int, default=1,
+                        help="number of hops from the seed users to get ids for (default: 1)")
+    parser.add_argument("--max-expand", metavar="N", type=int, default=0,
+                        help="maximum ids per user and relation to expand the crawl with")
+    parser.add_argument("--max-users", metavar="N", type=int, default=0,
+                        help="stop after getting the ids of this number of users")
+    parser.add_argument("--priority", action="store_true", required=False,
+                        help="expand the users discovered by most crawled users first")
+    parser.add_argument("--binary", action="store_true", required=False,
+                        help="write ids in compact binary format instead of plain text")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    args = _parse_args(parser)
+    user_ids = _read_integers(args.user_ids)
+    _safe_call(users.crawl, args.output_dir, user_ids, relations=args.relations,
+               depth=args.depth, max_expand=args.max_expand, max_users=args.max_users,
+               priority=args.priority, binary=args.binary, compression=args.compression)
+
+### Tools for the Toolbox Daemon ###
+
+def tt_daemon():
+    """Interface to daemon.run_daemon()"""
+    from . import daemon
+    parser = ArgumentParser(description=daemon.run_daemon.__doc__)
+    parser.add_argument("--socket", metavar="FILE", required=False,
+                        help="UNIX socket to listen on for jobs (default from config)")
+    parser.add_argument("--workers", metavar="N", type=int, required=False,
+                        help="number of jobs to run concurrently (default from config)")
+    args = _parse_args(parser)
+    _safe_call(daemon.run_daemon, socket_path=args.socket, workers=args.workers)
+
+### Tools for Twitter Ids ###
+
+def tt_ids_convert():
+    """Convert a file of Twitter ids between the plain text and compact binary formats."""
+    parser = ArgumentParser(description=tt_ids_convert.__doc__)
+    parser.add_argument("--input-file", metavar="FILE", required=True,
+                        help="file with input ids (text or binary format)")
+    parser.add_argument("--output-file", metavar="FILE", required=True,
+                        help="file for output ids (binary or text format)")
+    parser.add_argument("--to", choices=["binary", "text"], required=True,
+                        help="format of the output file")
+    parser.add_argument("--sort", action="store_true", required=False,
+                        help="sort the ids when converting to binary format")
+    args = _parse_args(parser)
+    if args.to == "binary":
+        _safe_call(text_to_binary, args.input_file, args.output_file, sort=args.sort)
+    else:
+        _safe_call(binary_to_text, args.input_file, args.output_file)
+
 ### Tools for Bulk Processing ###
 
 def tt_tweets_bulk_get_retweets():
     """Interface to tweets.bulk_get_retweets()"""
+    from . import tweets
     parser = ArgumentParser(description=tweets.bulk_get_retweets.__doc__)
     parser.add_argument("--tweet-ids", metavar="FILE", required=True,
-                        help="file with input Tweet ids (text format)")
+                        help="file with input Tweet ids (text format, - for standard input)")
     parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
                         help="directory for output hydrated Retweets (JSON format)")
-    args = parser.parse_args()
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="number of items to process concurrently (default: 1)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    _add_shards_argument(parser)
+    args = _parse_args(parser)
     tweet_ids = _read_integers(args.tweet_ids)
-    _safe_call(tweets.bulk_get_retweets, args.output_dir, tweet_ids)
+    _safe_call(tweets.bulk_get_retweets, args.output_dir, tweet_ids,
+               workers=args.workers, compression=args.compression, shards=args.shards)
 
 def tt_tweets_bulk_get_timeline():
     """Interface to tweets.bulk_get_timeline()"""
+    from . import tweets
     parser = ArgumentParser(description=tweets.bulk_get_timeline.__doc__)
     parser.add_argument("--user-ids", metavar="FILE",
-                        help="file with input user ids (text format)")
+                        help="file with input user ids (text format, - for standard input)")
     parser.add_argument("--screen-names", metavar="FILE",
-                        help="file with input user screen names (text format)")
+                        help="file with input user screen names (text format, - for standard input)")
     parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
                         help="directory for output hydrated Tweets (JSON format)")
-    args = parser.parse_args()
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="number of items to process concurrently (default: 1)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    _add_shards_argument(parser)
+    args = _parse_args(parser)
     user_ids = _read_integers(args.user_ids)
     screen_names = _read_strings(args.screen_names)
-    _safe_call(tweets.bulk_get_timeline, args.output_dir, user_ids, screen_names)
+    _safe_call(tweets.bulk_get_timeline, args.output_dir, user_ids, screen_names,
+               workers=args.workers, compression=args.compression, shards=args.shards)
+
+def tt_tweets_sync_timelines():
+    """Interface to tweets.sync_timelines()"""
+    from . import tweets
+    parser = ArgumentParser(description=tweets.sync_timelines.__doc__)
+    parser.add_argument("--user-ids", metavar="FILE", required=True,
+                        help="file with input user ids (text format, - for standard input)")
+    parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
+                        help="directory for output hydrated Tweets (JSON format) and sync state")
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="number of items to process concurrently (default: 1)")
+    parser.add_argument("--max-users", metavar="N", type=int, default=0,
+                        help="maximum number of due users to sync in this run")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    args = _parse_args(parser)
+    user_ids = _read_integers(args.user_ids)
+    _safe_call(tweets.sync_timelines, args.output_dir, user_ids, workers=args.workers,
+               max_users=args.max_users, compression=args.compression)
 
 def tt_tweets_bulk_search():
     """Interface to tweets.bulk_search()"""
+    from . import tweets
     parser = ArgumentParser(description=tweets.bulk_search.__doc__)
     parser.add_argument("--queries", metavar="FILE", required=True,
-                        help="file with input queries (text format)")
+                        help="file with input queries (text format, - for standard input)")
     parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
                         help="directory for output hydrated Tweets (JSON format)")
-    args = parser.parse_args()
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="number of items to process concurrently (default: 1)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    _add_shards_argument(parser)
+    args = _parse_args(parser)
     queries = _read_strings(args.queries)
-    _safe_call(tweets.bulk_search, args.output_dir, queries)
+    _safe_call(tweets.bulk_search, args.output_dir, queries,
+               workers=args.workers, compression=args.compression, shards=args.shards)
 
 def tt_users_bulk_get_followers():
     """Interface to users.bulk_get_followers()"""
+    from . import users
     parser = ArgumentParser(description=users.bulk_get_followers.__doc__)
     parser.add_argument("--user-ids", metavar="FILE",
-                        help="file with input user ids (text format)")
+                        help="file with input user ids (text format, - for standard input)")
     parser.add_argument("--screen-names", metavar="FILE",
-                        help="file with input user screen names (text format)")
+                        help="file with input user screen names (text format, - for standard input)")
     parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
-                        help="directory for output follower ids (text format)")
-    args = parser.parse_args()
+                        help="directory for output follower ids (text or binary format)")
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="number of items to process concurrently (default: 1)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    _add_shards_argument(parser)
+    _add_ids_format_arguments(parser)
+    args = _parse_args(parser)
     user_ids = _read_integers(args.user_ids)
     screen_names = _read_strings(args.screen_names)
-    _safe_call(users.bulk_get_followers, args.output_dir, user_ids, screen_names)
+    _safe_call(users.bulk_get_followers, args.output_dir, user_ids, screen_names,
+               workers=args.workers, binary=args.binary, sort=args.sort,
+               compression=args.compression, shards=args.shards)
 
 def tt_users_bulk_get_friends():
     """Interface to users.bulk_get_friends()"""
+    from . import users
     parser = ArgumentParser(description=users.bulk_get_friends.__doc__)
     parser.add_argument("--user-ids", metavar="FILE",
-                        help="file with input user ids (text format)")
+                        help="file with input user ids (text format, - for standard input)")
     parser.add_argument("--screen-names", metavar="FILE",
-                        help="file with input user screen names (text format)")
+                        help="file with input user screen names (text format, - for standard input)")
     parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
-                        help="directory for output friend ids (text format)")
-    args = parser.parse_args()
+                        help="directory for output friend ids (text or binary format)")
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="number of items to process concurrently (default: 1)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    _add_shards_argument(parser)
+    _add_ids_format_arguments(parser)
+    args = _parse_args(parser)
     user_ids = _read_integers(args.user_ids)
     screen_names = _read_strings(args.screen_names)
-    _safe_call(users.bulk_get_friends, args.output_dir, user_ids, screen_names)
+    _safe_call(users.bulk_get_friends, args.output_dir, user_ids, screen_names,
+               workers=args.workers, binary=args.binary, sort=args.sort,
+               compression=args.compression, shards=args.shards)
 
 def tt_users_bulk_search():
     """Interface to users.bulk_search()"""
+    from . import users
     parser = ArgumentParser(description=users.bulk_search.__doc__)
     parser.add_argument("--queries", metavar="FILE", required=True,
-                        help="file with input queries (text format)")
+                        help="file with input queries (text format, - for standard input)")
     parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
                         help="directory for output hydrated users (JSON format)")
-    args = parser.parse_args()
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="number of items to process concurrently (default: 1)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_EXTENSIONS), required=False,
+                        help="compress the output files")
+    _add_shards_argument(parser)
+    args = _parse_args(parser)
     queries = _read_strings(args.queries)
-    _safe_call(users.bulk_search, args.output_dir, queries)
+    _safe_call(users.bulk_search, args.output_dir, queries,
+               workers=args.workers, compression=args.compression, shards=args.shards)
+
+def tt_bulk_export():
+    """Interface to shards.export_shards()"""
+    from . import shards
+    parser = ArgumentParser(description=shards.export_shards.__doc__)
+    parser.add_argument("--input-dir", metavar="DIRECTORY", required=True,
+                        help="directory with the packed shard store of a bulk tool")
+    parser.add_argument("--output-dir", metavar="DIRECTORY", required=True,
+                        help="directory for the exported output files (one per input)")
+    args = _parse_args(parser)
+    _safe_call(shards.export_shards, args.input_dir, args.output_dir)
+
+### Single entry point for all the Tools ###
+
+def _get_tools():
+    return dict((name[len("tt_"):], func) for name, func in globals().items()
+                if name.startswith("tt_") and callable(func))
+
+def tt():  # pylint: disable=invalid-name
+    """Run any of the Toolbox tools as 'tt <group> <command> [arguments]'."""
+    tools = _get_tools()
+    for num_words in (2, 1):
+        name = "_".join(sys.argv[1:1 + num_words]).replace("-", "_")
+        if len(sys.argv) > num_words and name in tools:
+            sys.argv[:1 + num_words] = [" ".join(["tt"] + sys.argv[1:1 + num_words])]
+            return tools[name]()
+    print("usage: tt <group> <command> [arguments]\n\navailable tools:")
+    for name in sorted(tools):
+        print("  %s" % name.replace("_", " ", 1).replace("_", "-"))
+    sys.exit(0 if sys.argv[1:2] in (["-h"], ["--help"]) else 2)
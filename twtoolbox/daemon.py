@@ -0,0 +1,335 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Toolbox daemon module, running REST API jobs over shared sessions and rate limit state."""
+
+import os
+import json
+import time
+import socket
+import logging
+from threading import Thread, Lock, Event, local
+from itertools import islice
+from collections import deque
+from importlib import import_module
+from contextlib import closing
+from os import path
+from queue import Queue
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from tweepy import TweepError
+from .helpers import init_logger, read_config, Session, METRICS
+
+# module constants
+CONFIG_SECTION = "daemon"
+DATA_BUFFER_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 10000
+STREAM_MARKER = "__stream__"
+JOB_FUNCTIONS = {
+    "twtoolbox.tweets": ("get_hydrated", "get_retweets", "get_timeline", "search"),
+    "twtoolbox.users": ("get_hydrated", "get_followers", "get_friends", "search"),
+}
+
+# module logging
+LOGGER = logging.getLogger(__name__)
+init_logger(LOGGER)
+
+# job being run by the current thread, for routing its log records to the client
+_CURRENT = local()
+
+def get_socket_path(config=None, socket_path=None):
+    """Get the UNIX socket path of the daemon, from the config if not given."""
+    if not socket_path:
+        config = config if config is not None else read_config()
+        socket_path = config.get(CONFIG_SECTION, "socket")
+    return path.expanduser(socket_path)
+
+def _get_function_name(function):
+    return "%s.%s" % (function.__module__, function.__name__)
+
+def _get_job_function(name):
+    module_name, _, function_name = name.rpartition(".")
+    if function_name not in JOB_FUNCTIONS.get(module_name, ()):
+        raise ValueError("unsupported job function: %s" % name)
+    return getattr(import_module(module_name), function_name)
+
+def _is_streamed(value):
+    # iterable inputs (lists, ranges, generators, etc) are streamed after the request
+    return hasattr(value, "__iter__") and not isinstance(value, (dict, str))
+
+def _send_streams(client, streams):
+    try:
+        for idx, stream in enumerate(streams):
+            iterator = iter(stream)
+            while True:
+                items = list(islice(iterator, STREAM_CHUNK_SIZE))
+                client.sendall((json.dumps({"stream": idx, "items": items}) +
+                                "\n").encode("utf-8"))
+                if not items:
+                    break
+    except (IOError, OSError):
+        pass  # the daemon closed the connection, the job result tells why
+
+class _StreamReader(object):
+    """Reader of the iterable inputs of a job, streamed by its client in chunks.
+
+    Chunks are tagged with their input, so inputs can be consumed in any order."""
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self._chunks = {}
+        self._ended = set()
+        self._lock = Lock()
+
+    def _get_chunk(self, idx):
+        with self._lock:
+            chunks = self._chunks.setdefault(idx, deque())
+            while not chunks:
+                if idx in self._ended:
+                    return None
+                line = self.rfile.readline()
+                if not line:
+                    raise IOError("client closed the connection while streaming inputs")
+                chunk = json.loads(line.decode("utf-8"))
+                if chunk["items"]:
+                    self._chunks.setdefault(chunk["stream"], deque()).append(chunk["items"])
+                else:
+                    self._ended.add(chunk["stream"])
+            return chunks.popleft()
+
+    def gen_items(self, idx):
+        """Generate the items of a streamed input."""
+        while True:
+            chunk = self._get_chunk(idx)
+            if chunk is None:
+                return
+            for item in chunk:
+                yield item
+
+    def decode(self, value):
+        """Replace a streamed input marker with a generator of its items."""
+        if isinstance(value, dict) and STREAM_MARKER in value:
+            return self.gen_items(value[STREAM_MARKER])
+        return value
+
+class _JobWriter(object):
+    """Writer that sends the output of a job to its client in buffered chunks."""
+
+    def __init__(self, job):
+        self.job = job
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        """Buffer data for the client, sending it when the buffer is full."""
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= DATA_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Send the buffered data to the client."""
+        if self._buffer:
+            self.job.send("data", data="".join(self._buffer))
+            self._buffer = []
+            self._size = 0
+
+class Job(object):
+    """Job submitted by a client, sending its events back over the client connection."""
+
+    def __init__(self, request, wfile, rfile=None):
+        self.function = _get_job_function(request["function"])
+        self.name = request["function"]
+        reader = _StreamReader(rfile)
+        self.args = [reader.decode(arg) for arg in request.get("args", [])]
+        self.kwargs = dict((key, reader.decode(value))
+                           for key, value in request.get("kwargs", {}).items())
+        self.finished = Event()
+        self._wfile = wfile
+        self._lock = Lock()
+
+    def send(self, event, **fields):
+        """Send an event to the client of the job."""
+        fields["event"] = event
+        data = (json.dumps(fields, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            self._wfile.write(data)
+
+    def run(self, session):
+        """Run the job using a shared session and send its output and result to the client."""
+        _CURRENT.job = self
+        error = None
+        started = time.time()
+        try:
+            self.send("started")
+            writer = _JobWriter(self)
+            self.function(writer, *self.args, session=session, **self.kwargs)
+            writer.flush()
+        except Exception as excp:  # pylint: disable=broad-except
+            error = str(excp) or excp.__class__.__name__
+        finally:
+            _CURRENT.job = None
+        LOGGER.info("job %s finished in %.1fs%s", self.name, time.time() - started,
+                    ": %s" % error if error else "")
+        METRICS.inc("daemon_jobs_total", function=self.name, status="error" if error else "ok")
+        try:
+            self.send("finished", error=error)
+        except (IOError, OSError):
+            pass
+        self.finished.set()
+
+class _JobLogHandler(logging.Handler):
+    """Logging handler that forwards the records of a job to its client."""
+
+    def emit(self, record):
+        job = getattr(_CURRENT, "job", None)
+        if job is None:
+            return
+        try:
+            job.send("log", level=record.levelno, name=record.name, message=record.getMessage())
+        except (IOError, OSError):
+            pass
+
+class _JobRequestHandler(StreamRequestHandler):
+    """Request handler that queues a job and waits for it to finish."""
+
+    def handle(self):
+        try:
+            job = Job(json.loads(self.rfile.readline().decode("utf-8")), self.wfile, self.rfile)
+        except (KeyError, ValueError) as excp:
+            self.wfile.write((json.dumps({"event": "finished", "error": str(excp)}) +
+                              "\n").encode("utf-8"))
+            return
+        self.server.submit(job)
+        job.finished.wait()
+
+def _is_listening(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)  # pylint: disable=no-member
+    with closing(client):
+        try:
+            client.connect(socket_path)
+            return True
+        except (IOError, OSError):
+            return False
+
+class JobDaemon(ThreadingUnixStreamServer):
+    """Daemon that accepts jobs on a UNIX socket and runs them with a pool of worker threads."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, session, workers=1):
+        if path.exists(socket_path):
+            if _is_listening(socket_path):
+                raise ValueError("a daemon is already listening on %s" % socket_path)
+            os.remove(socket_path)  # stale socket of a previous daemon
+        ThreadingUnixStreamServer.__init__(self, socket_path, _JobRequestHandler)
+        os.chmod(socket_path, 0o600)
+        self.socket_path = socket_path
+        self.session = session
+        self.jobs = Queue()
+        for num in range(workers):
+            thread = Thread(target=self._run_jobs, name="daemon-worker-%d" % num)
+            thread.daemon = True
+            thread.start()
+
+    def _run_jobs(self):
+        while True:
+            job = self.jobs.get()
+            METRICS.set("daemon_queued_jobs", self.jobs.qsize())
+            job.run(self.session)
+
+    def submit(self, job):
+        """Queue a job for running."""
+        job.send("queued", position=self.jobs.qsize())
+        self.jobs.put(job)
+        METRICS.set("daemon_queued_jobs", self.jobs.qsize())
+
+    def server_close(self):
+        ThreadingUnixStreamServer.server_close(self)
+        if path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+def run_daemon(socket_path=None, workers=None):
+    """Run the Toolbox daemon, accepting REST API jobs on a local UNIX socket."""
+    LOGGER.info("run_daemon() starting")
+
+    # initialize config and the session shared by all jobs
+    config = read_config()
+    socket_path = get_socket_path(config, socket_path)
+    workers = workers if workers is not None else config.getint(CONFIG_SECTION, "workers")
+    session = Session(config)
+
+    # warm up the rate limit budgets of all credentials
+    for pool in (session.app_auth_pool, session.oauth_pool):
+        try:
+            pool.refresh_budgets()
+        except TweepError as err:
+            LOGGER.warning("could not get the rate limit status: %s", err)
+
+    # serve jobs until interrupted
+    logging.getLogger("twtoolbox").addHandler(_JobLogHandler())
+    with closing(JobDaemon(socket_path, session, workers=workers)) as daemon:
+        LOGGER.info("listening on %s with %d worker(s)", socket_path, workers)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    # finished
+    LOGGER.info("run_daemon() finished")
+
+def submit_job(function, writer, *args, **kwargs):
+    """Submit a job to a running daemon, writing its output and logging its progress here."""
+    socket_path = get_socket_path(socket_path=kwargs.pop("socket_path", None))
+    streams = []
+
+    def _encode(value):
+        if not _is_streamed(value):
+            return value
+        streams.append(value)
+        return {STREAM_MARKER: len(streams) - 1}
+
+    request = {
+        "function": _get_function_name(function),
+        "args": [_encode(arg) for arg in args],
+        "kwargs": dict((key, _encode(value)) for key, value in kwargs.items()),
+    }
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)  # pylint: disable=no-member
+    with closing(client):
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+
+        # stream the iterable inputs while reading the events, so neither side can block
+        sender = Thread(target=_send_streams, args=(client, streams), name="daemon-inputs")
+        sender.daemon = True
+        sender.start()
+        write_id = getattr(writer, "write_id", None)
+        for line in client.makefile("rb"):
+            event = json.loads(line.decode("utf-8"))
+            if event["event"] == "data" and write_id is not None:
+                for _id in event["data"].split():
+                    write_id(int(_id))
+            elif event["event"] == "data":
+                writer.write(event["data"])
+            elif event["event"] == "log":
+                LOGGER.log(event["level"], "[%s] %s", event["name"], event["message"])
+            elif event["event"] == "queued":
+                LOGGER.info("job queued (%d job(s) ahead)", event["position"])
+            elif event["event"] == "started":
+                LOGGER.info("job started")
+            elif event["event"] == "finished":
+                if event["error"]:
+                    raise RuntimeError("job failed: %s" % event["error"])
+                return
+    raise IOError("connection to the daemon closed before the job finished")
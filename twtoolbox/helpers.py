@@ -15,34 +15,105 @@
 
 """Twitter Toolbox for Python helper functions."""
 
+import io
+import sys
 import logging
 import json
-from codecs import getreader
+import time
+import re
+from threading import Thread, Event, Lock, BoundedSemaphore, local, setprofile
 from os import path, makedirs
-try:
-    from configparser import ConfigParser  # pylint: disable=import-error
-except ImportError:
-    from ConfigParser import ConfigParser  # pylint: disable=import-error
-try:
-    from itertools import izip_longest as zip_longest  # pylint: disable=no-name-in-module
-except ImportError:
-    from itertools import zip_longest  # pylint: disable=no-name-in-module
-from pkg_resources import resource_stream
+from os import replace as replace_file
+from configparser import ConfigParser
+from itertools import zip_longest
+from pkgutil import get_data
 import colorlog
-from tweepy import TweepError, API, AppAuthHandler, OAuthHandler, Cursor
+from .writers import get_compression, open_writer, open_reader, truncate_torn_tail
+from .ids import BINARY_ID_SIZE
 
 # module constants
 CONFIG_DEFAULTS = "defaults.cfg"
 CONFIG_USER = "~/.twtoolbox.cfg"
+CONFIG_CREDENTIALS = "twitter"
+CHECKPOINT_SUFFIX = ".ckpt"
+CHECKPOINT_INTERVAL = 1000
+BULK_ITEMS_PER_WORKER = 2
+RATE_LIMIT_WINDOW = 15 * 60
+RATE_LIMIT_MARGIN = 5
+METRICS_PREFIX = "twtoolbox_"
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+METRICS_FILE_INTERVAL = 10
+RATE_LIMIT_RESOURCES = {
+    "statuses_lookup": "statuses/lookup",
+    "retweets": "statuses/retweets/:id",
+    "user_timeline": "statuses/user_timeline",
+    "search": "search/tweets",
+    "lookup_users": "users/lookup",
+    "followers_ids": "followers/ids",
+    "friends_ids": "friends/ids",
+    "search_users": "users/search",
+}
 
-def _get_latest_id(filename):
-    latest_id = None
-    with open(filename) as reader:
+# the id of a Twitter object always comes first, before the ids of any nested object
+_OBJ_ID_PATTERN = re.compile(br'"id":(\d+)')
+
+def read_checkpoint(filename):
+    """Read the JSON checkpoint sidecar of a file, or None if missing or invalid."""
+    try:
+        with open(filename + CHECKPOINT_SUFFIX) as reader:
+            return json.load(reader)
+    except (IOError, OSError, ValueError):
+        return None
+
+def write_checkpoint(filename, checkpoint):
+    """Atomically write the JSON checkpoint sidecar of a file."""
+    tmp_filename = filename + CHECKPOINT_SUFFIX + ".tmp"
+    with open(tmp_filename, "w") as writer:
+        json.dump(checkpoint, writer, separators=(",", ":"))
+    replace_file(tmp_filename, filename + CHECKPOINT_SUFFIX)
+
+def _skip_data(reader, size):
+    # decompressing readers may not be seekable, in which case the data is read and discarded
+    if reader.seekable():
+        return reader.seek(size)
+    remaining = size
+    while remaining > 0:
+        data = reader.read(min(remaining, io.DEFAULT_BUFFER_SIZE * 16))
+        if not data:
+            break
+        remaining -= len(data)
+    return size - remaining
+
+def _scan_checkpoint(filename, checkpoint):
+    # scan the data written after a checkpoint, or None if the checkpoint is ahead of the data
+    with open_reader(filename) as reader:
+        if _skip_data(reader, checkpoint["offset"]) < checkpoint["offset"]:
+            return None
         for line in reader:
-            obj = json.loads(line)
-            if latest_id is None or obj["id"] > latest_id:
-                latest_id = obj["id"]
-    return latest_id
+            if not line.endswith(b"\n"):
+                break  # incomplete last line
+            match = _OBJ_ID_PATTERN.search(line)
+            obj_id = int(match.group(1)) if match else json.loads(line.decode("utf-8"))["id"]
+            if checkpoint["latest_id"] is None or obj_id > checkpoint["latest_id"]:
+                checkpoint["latest_id"] = obj_id
+            checkpoint["count"] += 1
+            checkpoint["offset"] += len(line)
+    return checkpoint
+
+def _get_checkpoint(filename):
+    # start from the checkpoint sidecar (if valid) and scan only the data written after it
+    checkpoint = read_checkpoint(filename)
+    if checkpoint is not None and get_compression(filename) is None and \
+       checkpoint["offset"] > path.getsize(filename):
+        checkpoint = None
+    if checkpoint is not None:
+        checkpoint = _scan_checkpoint(filename, checkpoint)
+    if checkpoint is None:
+        checkpoint = _scan_checkpoint(filename, {"latest_id": None, "count": 0, "offset": 0})
+    return checkpoint
+
+def _get_latest_id(filename):
+    return _get_checkpoint(filename)["latest_id"]
 
 def init_logger(logger):
     """Initialize a logger object."""
@@ -55,6 +126,10 @@ def init_logger(logger):
     logger.setLevel(logging.INFO)
     logger.addHandler(colored_handler)
 
+# module logging
+LOGGER = logging.getLogger(__name__)
+init_logger(LOGGER)
+
 def gen_basic_config(consumer_key, consumer_secret, access_token_key, access_token_secret):
     """Generate an initial basic config with Twitter API authentication data."""
     config = ConfigParser()
@@ -69,27 +144,585 @@ def gen_basic_config(consumer_key, consumer_secret, access_token_key, access_tok
 def read_config():
     """Read default config and overlay user-defined config."""
     config = ConfigParser()
-    config.readfp(getreader('ascii')(resource_stream(__name__, CONFIG_DEFAULTS)))  # pylint: disable=deprecated-method
+    config.readfp(io.StringIO(get_data(__name__, CONFIG_DEFAULTS).decode("ascii")))  # pylint: disable=deprecated-method
     config.read(path.expanduser(CONFIG_USER))
     return config
 
-def get_app_auth_api(config):
+def get_credential_sections(config):
+    """Get the names of all config sections with Twitter API authentication data."""
+    return [section for section in config.sections()
+            if section == CONFIG_CREDENTIALS or section.startswith(CONFIG_CREDENTIALS + ":")]
+
+# Tweepy (and thus requests) is imported on first use only, to keep the CLI startup fast
+
+def _get_app_auth_handler(config, section):
+    from tweepy import AppAuthHandler
+    return AppAuthHandler(
+        config.get(section, "consumer_key"),
+        config.get(section, "consumer_secret"))
+
+def _get_oauth_handler(config, section):
+    from tweepy import OAuthHandler
+    auth = OAuthHandler(
+        config.get(section, "consumer_key"),
+        config.get(section, "consumer_secret"))
+    auth.set_access_token(
+        config.get(section, "access_token_key"),
+        config.get(section, "access_token_secret"))
+    return auth
+
+def get_app_auth_api(config, section=CONFIG_CREDENTIALS):
     """Get a Tweepy API object configured using Application-wide Auth."""
-    auth = AppAuthHandler(
-        config.get("twitter", "consumer_key"),
-        config.get("twitter", "consumer_secret"))
+    from tweepy import API
+    auth = _get_app_auth_handler(config, section)
     return API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
 
-def get_oauth_api(config):
+def get_oauth_api(config, section=CONFIG_CREDENTIALS):
     """Get a Tweepy API object configured using OAuth."""
-    auth = OAuthHandler(
-        config.get("twitter", "consumer_key"),
-        config.get("twitter", "consumer_secret"))
-    auth.set_access_token(
-        config.get("twitter", "access_token_key"),
-        config.get("twitter", "access_token_secret"))
+    from tweepy import API
+    auth = _get_oauth_handler(config, section)
     return API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
 
+def _format_labels(labels, extra=None):
+    labels = labels + (extra,) if extra else labels
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, value) for name, value in labels)
+
+class Metrics(object):
+    """Thread-safe registry of counters, gauges and histograms, disabled until enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set the value of a gauge."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """Observe a value (e.g. a duration in seconds) in a histogram."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0}
+            for idx, bound in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][idx] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def get_snapshot(self):
+        """Get the current values of all metrics as a JSON-serializable dictionary."""
+        def _get_name(key):
+            return "%s%s%s" % (METRICS_PREFIX, key[0], _format_labels(key[1]))
+        with self._lock:
+            return {
+                "uptime": time.time() - self.started,
+                "counters": dict((_get_name(key), value)
+                                 for key, value in self._counters.items()),
+                "gauges": dict((_get_name(key), value) for key, value in self._gauges.items()),
+                "histograms": dict((_get_name(key), {
+                    "buckets": dict(zip([str(bound) for bound in METRICS_BUCKETS],
+                                        histogram["buckets"])),
+                    "sum": histogram["sum"], "count": histogram["count"]})
+                                   for key, histogram in self._histograms.items()),
+            }
+
+    def get_prometheus(self):
+        """Get the current values of all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted(set(key[0] for key in metrics)):
+                    lines.append("# TYPE %s%s %s" % (METRICS_PREFIX, name, kind))
+                    for key in sorted(key for key in metrics if key[0] == name):
+                        lines.append("%s%s%s %s" % (METRICS_PREFIX, name, _format_labels(key[1]),
+                                                    metrics[key]))
+            for name in sorted(set(key[0] for key in self._histograms)):
+                lines.append("# TYPE %s%s histogram" % (METRICS_PREFIX, name))
+                for key in sorted(key for key in self._histograms if key[0] == name):
+                    histogram = self._histograms[key]
+                    cumulative = 0
+                    for bound, count in zip(METRICS_BUCKETS, histogram["buckets"]):
+                        cumulative += count
+                        lines.append("%s%s_bucket%s %d" % (METRICS_PREFIX, name, _format_labels(
+                            key[1], ("le", bound)), cumulative))
+                    lines.append("%s%s_bucket%s %d" % (METRICS_PREFIX, name, _format_labels(
+                        key[1], ("le", "+Inf")), histogram["count"]))
+                    lines.append("%s%s_sum%s %s" % (METRICS_PREFIX, name, _format_labels(key[1]),
+                                                    histogram["sum"]))
+                    lines.append("%s%s_count%s %d" % (METRICS_PREFIX, name,
+                                                      _format_labels(key[1]), histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+# process-wide metrics registry
+METRICS = Metrics()
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Enable the metrics and serve them over HTTP in the Prometheus format."""
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class _MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Serve the metrics in the Prometheus text format."""
+            data = METRICS.get_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    METRICS.enabled = True
+    server = HTTPServer((host, port), _MetricsRequestHandler)
+    thread = Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    LOGGER.info("serving metrics on http://%s:%d/metrics", host, server.server_port)
+    return server
+
+class MetricsFileWriter(object):
+    """Periodic writer of the metrics as a JSON stats file, rewritten atomically."""
+
+    def __init__(self, filename, interval=METRICS_FILE_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="metrics-file")
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Write the current metrics to the stats file."""
+        with open(self.filename + ".tmp", "w") as writer:
+            json.dump(METRICS.get_snapshot(), writer, indent=2, sort_keys=True)
+        replace_file(self.filename + ".tmp", self.filename)
+
+    def start(self):
+        """Start writing the stats file periodically."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop writing the stats file periodically and write it a last time."""
+        self._stopped.set()
+        self.write()
+
+def start_metrics_file(filename, interval=METRICS_FILE_INTERVAL):
+    """Enable the metrics and write them periodically to a JSON stats file."""
+    METRICS.enabled = True
+    writer = MetricsFileWriter(filename, interval=interval)
+    writer.start()
+    return writer
+
+class _NullTimer(object):
+    """Phase timer that does nothing, used while profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+class _PhaseTimer(object):
+    """Phase timer that records its wall time, excluding the time of nested phase timers."""
+
+    def __init__(self, profiler, phase):
+        self.profiler = profiler
+        self.phase = phase
+        self.started = None
+
+    def __enter__(self):
+        self.profiler.get_stack().append(0.0)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.started
+        stack = self.profiler.get_stack()
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        self.profiler.record(self.phase, elapsed - nested)
+
+class Profiler(object):
+    """Thread-safe recorder of the wall time spent per phase, disabled until enabled.
+
+    Phase times are summed over all threads and exclude the time of nested phases."""
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self._phases = {}
+        self._local = local()
+        self._lock = Lock()
+        self._null_timer = _NullTimer()
+
+    def get_stack(self):
+        """Get the stack of nested phase times of the calling thread."""
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def timer(self, phase):
+        """Get a context manager that records the wall time spent in a phase."""
+        if not self.enabled:
+            return self._null_timer
+        return _PhaseTimer(self, phase)
+
+    def timed(self, phase, function):
+        """Wrap a function so the wall time spent in its calls is recorded in a phase."""
+        def _timed(*args, **kwargs):
+            with self.timer(phase):
+                return function(*args, **kwargs)
+        return _timed
+
+    def timed_iter(self, phase, iterable):
+        """Wrap an iterable so the wall time spent getting its items is recorded in a phase."""
+        if not self.enabled:
+            return iterable
+        return self._gen_timed(phase, iter(iterable))
+
+    def _gen_timed(self, phase, iterator):
+        while True:
+            with self.timer(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, phase, seconds):
+        """Record wall time spent in a phase."""
+        with self._lock:
+            totals = self._phases.setdefault(phase, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def get_summary(self):
+        """Get a table of the wall time spent per phase, slowest first."""
+        wall_time = time.time() - self.started
+        with self._lock:
+            phases = sorted(self._phases.items(), key=lambda item: -item[1][0])
+        lines = ["%-20s %10s %12s %8s" % ("phase", "calls", "seconds", "% wall")]
+        for phase, (seconds, calls) in phases:
+            lines.append("%-20s %10d %12.3f %8.1f" % (
+                phase, calls, seconds, 100.0 * seconds / wall_time if wall_time else 0))
+        lines.append("%-20s %10s %12.3f %8.1f" % ("wall time", "", wall_time, 100.0))
+        return "\n".join(lines) + "\n"
+
+# process-wide phase profiler
+PROFILER = Profiler()
+
+class ProfileRecorder(object):
+    """Recorder of a profiled run, optionally also capturing a cProfile dump of all threads."""
+
+    def __init__(self, filename=None, output=None):
+        self.filename = filename
+        self.output = output if output is not None else sys.stderr
+        self._profiles = []
+        self._lock = Lock()
+
+    def _profile_thread(self, *_):
+        # installed as the profile function of new threads, hands them over to cProfile
+        import cProfile
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        """Start recording the phase times and, if a dump file is given, profiling all threads."""
+        PROFILER.started = time.time()
+        PROFILER.enabled = True
+        if self.filename is not None:
+            setprofile(self._profile_thread)
+            self._profile_thread()
+
+    def stop(self):
+        """Stop profiling, write the cProfile dump (if any) and print the phase summary."""
+        PROFILER.enabled = False
+        if self.filename is not None:
+            import pstats
+            setprofile(None)
+            with self._lock:
+                profiles = list(self._profiles)
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(self.filename)
+            LOGGER.info("wrote profile of %d thread(s) to: %s", len(profiles), self.filename)
+        self.output.write(PROFILER.get_summary())
+        self.output.flush()
+
+def start_profiler(filename=None):
+    """Enable the phase profiler and, if a dump file is given, profile all threads with cProfile."""
+    recorder = ProfileRecorder(filename)
+    recorder.start()
+    return recorder
+
+def _is_rate_limit_error(tweep_error):
+    from tweepy import RateLimitError
+    if isinstance(tweep_error, RateLimitError):
+        return True
+    return tweep_error.response is not None and tweep_error.response.status_code == 429
+
+class RateLimitTracker(object):
+    """Tracker of REST API rate limit budgets per credential and endpoint family."""
+
+    def __init__(self):
+        self._budgets = {}
+        self._lock = Lock()
+
+    def _set_budget(self, key, resource, limit, remaining, reset):
+        budget = self._budgets.get((key, resource))
+        if budget is not None and budget["reset"] == reset:
+            # responses can arrive out of order, keep the lowest known budget
+            remaining = min(remaining, budget["remaining"])
+            limit = limit if limit is not None else budget["limit"]
+        self._budgets[(key, resource)] = {"limit": limit, "remaining": remaining, "reset": reset}
+
+    def update(self, key, resource, headers):
+        """Record the budget of an endpoint family reported by response headers."""
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        if remaining is None or reset is None:
+            return
+        limit = headers.get("x-rate-limit-limit")
+        with self._lock:
+            self._set_budget(key, resource, int(limit) if limit is not None else None,
+                             int(remaining), int(reset))
+
+    def update_from_status(self, key, status):
+        """Record the budgets reported by the application/rate_limit_status endpoint."""
+        with self._lock:
+            for family in status["resources"].values():
+                for resource, budget in family.items():
+                    self._set_budget(key, resource.lstrip("/"), budget["limit"],
+                                     budget["remaining"], budget["reset"])
+
+    def exhaust(self, key, resource, reset=None):
+        """Mark the budget of an endpoint family as exhausted until its window resets."""
+        reset = int(reset) if reset is not None else int(time.time() + RATE_LIMIT_WINDOW)
+        with self._lock:
+            budget = self._budgets.get((key, resource), {})
+            self._budgets[(key, resource)] = {
+                "limit": budget.get("limit"), "remaining": 0, "reset": reset}
+
+    def reserve(self, keys, resource):
+        """Reserve a request on the credential with most remaining budget for an endpoint family.
+
+        Returns the reserved credential key, or None and the time to wait for a budget."""
+        with self._lock:
+            now = time.time()
+            best_key, best_remaining, earliest_reset = None, 0, None
+            for key in keys:
+                budget = self._budgets.get((key, resource))
+                if budget is None or budget["reset"] <= now:
+                    remaining = float("inf")  # unknown or renewed budget
+                else:
+                    remaining = budget["remaining"]
+                if remaining > best_remaining:
+                    best_key, best_remaining = key, remaining
+                elif remaining < 1 and (earliest_reset is None or budget["reset"] < earliest_reset):
+                    earliest_reset = budget["reset"]
+            if best_key is None:
+                return None, earliest_reset - now
+            budget = self._budgets.get((best_key, resource))
+            if budget is not None and budget["reset"] > now:
+                budget["remaining"] -= 1
+            return best_key, 0
+
+    def wait(self, keys, resource):
+        """Wait until one of the credentials has budget for an endpoint family and reserve it.
+
+        Only the calling thread is delayed, calls to other endpoint families are unaffected."""
+        while True:
+            key, wait_time = self.reserve(keys, resource)
+            if key is not None:
+                return key
+            LOGGER.warning("rate limit reached for %s on all %d credential(s), "
+                           "sleeping for %d seconds", resource, len(keys), wait_time)
+            METRICS.inc("rate_limit_sleeps_total", endpoint=resource)
+            METRICS.inc("rate_limit_sleep_seconds_total", wait_time + RATE_LIMIT_MARGIN,
+                        endpoint=resource)
+            with PROFILER.timer("rate_limit_sleep"):
+                time.sleep(wait_time + RATE_LIMIT_MARGIN)
+
+    def get_budgets(self, keys=None):
+        """Get the current budgets per endpoint family, aggregated over the given credentials."""
+        budgets = {}
+        with self._lock:
+            now = time.time()
+            for (key, resource), budget in self._budgets.items():
+                if keys is not None and key not in keys:
+                    continue
+                remaining = budget["remaining"]
+                if budget["reset"] <= now:
+                    if budget["limit"] is None:
+                        continue
+                    remaining = budget["limit"]  # the window was renewed
+                total = budgets.setdefault(resource, {"limit": 0, "remaining": 0, "reset": None})
+                total["remaining"] += remaining
+                if budget["limit"] is not None:
+                    total["limit"] += budget["limit"]
+                if budget["reset"] > now and (total["reset"] is None or
+                                              budget["reset"] < total["reset"]):
+                    total["reset"] = budget["reset"]
+        return budgets
+
+# shared tracker so rate limit budgets are kept across API pools of the same process
+RATE_LIMITS = RateLimitTracker()
+
+def _get_auth_key(auth):
+    from tweepy import AppAuthHandler
+    if isinstance(auth, AppAuthHandler):
+        return "app:%s" % auth.consumer_key
+    return "user:%s" % auth.access_token
+
+class _PooledMethod(object):  # pylint: disable=too-few-public-methods
+    """Tweepy API method that is dispatched through an API pool."""
+
+    def __init__(self, pool, name, pagination_mode=None):
+        self.pool = pool
+        self.name = name
+        if pagination_mode is not None:
+            self.pagination_mode = pagination_mode
+
+    def __call__(self, *args, **kwargs):
+        return self.pool.call(self.name, *args, **kwargs)
+
+class APIPool(object):
+    """Pool of Tweepy API objects that spreads requests over several credentials."""
+
+    def __init__(self, auths, tracker=None):
+        if not auths:
+            raise ValueError("at least one API authentication handler must be provided")
+        self.auths = dict((_get_auth_key(auth), auth) for auth in auths)
+        self.keys = list(self.auths.keys())
+        self.tracker = tracker if tracker is not None else RATE_LIMITS
+        self._local = local()
+
+    def __getattr__(self, name):
+        attr = getattr(self._get_api(self.keys[0]), name)
+        if not callable(attr):
+            return attr
+        return _PooledMethod(self, name, getattr(attr, "pagination_mode", None))
+
+    def _get_api(self, key):
+        # Tweepy keeps the last response in the API object, so keep one per thread
+        if not hasattr(self._local, "apis"):
+            self._local.apis = {}
+        if key not in self._local.apis:
+            from tweepy import API
+            api = self._local.apis[key] = API(self.auths[key])
+            if PROFILER.enabled:
+                api.parser.parse = PROFILER.timed("parse", api.parser.parse)
+        return self._local.apis[key]
+
+    def get_budgets(self):
+        """Get the current rate limit budgets per endpoint family of the pooled credentials."""
+        return self.tracker.get_budgets(self.keys)
+
+    def refresh_budgets(self):
+        """Refresh the rate limit budgets of all the pooled credentials from the API."""
+        for key in self.keys:
+            self.tracker.update_from_status(key, self._get_api(key).rate_limit_status())
+
+    def call(self, name, *args, **kwargs):
+        """Call an API method using the credential with most remaining budget."""
+        from tweepy import TweepError
+        if kwargs.get("create"):
+            return getattr(self._get_api(self.keys[0]), name)(*args, **kwargs)
+        resource = RATE_LIMIT_RESOURCES.get(name, name)
+        while True:
+            key = self.tracker.wait(self.keys, resource)
+            api = self._get_api(key)
+            api.last_response = None
+            started = time.time()
+            try:
+                with PROFILER.timer("network"):
+                    result = getattr(api, name)(*args, **kwargs)
+                self.tracker.update(key, resource, api.last_response.headers)
+                return result
+            except TweepError as err:
+                METRICS.inc("request_errors_total", endpoint=resource)
+                if not _is_rate_limit_error(err):
+                    if api.last_response is not None:
+                        self.tracker.update(key, resource, api.last_response.headers)
+                    raise
+                self.tracker.exhaust(key, resource, err.response.headers.get("x-rate-limit-reset"))
+                if len(self.keys) > 1:
+                    LOGGER.info("rate limit reached for %s, switching credentials", resource)
+            finally:
+                METRICS.inc("requests_total", endpoint=resource)
+                METRICS.observe("request_seconds", time.time() - started, endpoint=resource)
+
+def get_app_auth_pool(config):
+    """Get an API pool configured using Application-wide Auth for all credentials."""
+    return APIPool([_get_app_auth_handler(config, section)
+                    for section in get_credential_sections(config)])
+
+def get_oauth_pool(config):
+    """Get an API pool configured using OAuth for all credentials."""
+    return APIPool([_get_oauth_handler(config, section)
+                    for section in get_credential_sections(config)])
+
+class Session(object):
+    """Toolbox session holding the parsed config and API pools, shared by many calls.
+
+    Creating a session once per run avoids re-reading the config and re-authenticating
+    (e.g. exchanging bearer tokens) for every processed item."""
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else read_config()
+        self._pools = {}
+        self._lock = Lock()
+
+    def _get_pool(self, name, factory):
+        with self._lock:
+            if name not in self._pools:
+                self._pools[name] = factory(self.config)
+            return self._pools[name]
+
+    @property
+    def app_auth_pool(self):
+        """API pool using Application-wide Auth for all credentials, created on first use."""
+        return self._get_pool("app_auth", get_app_auth_pool)
+
+    @property
+    def oauth_pool(self):
+        """API pool using OAuth for all credentials, created on first use."""
+        return self._get_pool("oauth", get_oauth_pool)
+
+def get_session(session=None):
+    """Get the given Toolbox session, or a new one if not given."""
+    return session if session is not None else Session()
+
 def ensure_at_least_one(**kwargs):
     """Make sure at least one of the given named arguments has data."""
     one_found = False
@@ -114,62 +747,229 @@ def ensure_only_one(**kwargs):
 def gen_chunks(*iterables, **kwargs):
     """Generate sequential components chunks of certain size from n-iterables."""
     size = kwargs.get("size", 10)
-    merged = [(idx, el) for idx, iterable in enumerate(iterables) for el in iterable]
-    for chunk in zip_longest(*([iter(merged)] * size)):
+    merged = ((idx, el) for idx, iterable in enumerate(iterables) for el in iterable)
+    for chunk in zip_longest(*([merged] * size)):
         components = [[el[1] for el in chunk if el is not None and
                        el[0] == idx] for idx in range(len(iterables))]
         yield tuple(components)
 
 def write_ids(writer, endpoint, args, cursored=False, limit=0):
-    """Connect to an endpoint providing ids and write them in plain text format."""
+    """Connect to an endpoint providing ids and write them in plain text (or binary) format."""
+    from tweepy import Cursor
     num_ids = 0
     ids = endpoint(**args) if not cursored else \
           Cursor(endpoint, **args).items(limit)
+    write_id = getattr(writer, "write_id", None)
     for _id in ids:
-        writer.write("%d\n" % _id)
+        with PROFILER.timer("write"):
+            if write_id is not None:
+                write_id(_id)
+                num_bytes = BINARY_ID_SIZE
+            else:
+                data = "%d\n" % _id
+                writer.write(data)
+                num_bytes = len(data)
         num_ids += 1
+        METRICS.inc("objects_written_total", kind="ids")
+        METRICS.inc("bytes_written_total", num_bytes)
     return num_ids
 
-def write_objs(writer, endpoint, args, cursored=False, limit=0):
+def write_objs(writer, endpoint, args, cursored=False, limit=0, callback=None):  # pylint: disable=too-many-arguments
     """Connect to an endpoint providing Twitter objects and write them in JSON format."""
+    from tweepy import Cursor
     num_objs = 0
     objs = endpoint(**args) if not cursored else \
            Cursor(endpoint, **args).items(limit)
-    for obj in objs:
-        writer.write("%s\n" % json.dumps(obj._json, separators=(",", ":")))  # pylint: disable=protected-access
+    track_id = getattr(writer, "track_id", None)
+    # id-paginated cursors parse the pages themselves, outside of the API parser
+    for obj in PROFILER.timed_iter("parse", objs):
+        with PROFILER.timer("serialize"):
+            data = json.dumps(obj._json, separators=(",", ":"))  # pylint: disable=protected-access
+        with PROFILER.timer("write"):
+            writer.write("%s\n" % data)
+            if track_id is not None:
+                track_id(obj.id)
+        if callback is not None:
+            callback(obj, data)
         num_objs += 1
+        METRICS.inc("objects_written_total", kind="objects")
+        METRICS.inc("bytes_written_total", len(data) + 1)
     return num_objs
 
-def bulk_process(logger, output_dir, filename_tmpl, function, func_input, var_arg, resume=False):  # pylint: disable=too-many-arguments
-    """Process a function in bulk using an iterable input and a variable argument."""
+class CheckpointWriter(object):
+    """Writer that keeps a checkpoint sidecar file of the Twitter objects written."""
+
+    def __init__(self, writer, filename, checkpoint=None, interval=CHECKPOINT_INTERVAL):
+        checkpoint = checkpoint if checkpoint else {"latest_id": None, "count": 0, "offset": 0}
+        self.writer = writer
+        self.filename = filename
+        self.interval = interval
+        self.latest_id = checkpoint["latest_id"]
+        self.count = checkpoint["count"]
+        self.offset = checkpoint["offset"]
+        self._num_pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        """Write data to the underlying writer, accounting its size for the checkpoint."""
+        self.writer.write(data)
+        self.offset += len(data.encode("utf-8"))
+
+    def track_id(self, obj_id):
+        """Account a written Twitter object id, saving the checkpoint periodically."""
+        if self.latest_id is None or obj_id > self.latest_id:
+            self.latest_id = obj_id
+        self.count += 1
+        self._num_pending += 1
+        if self._num_pending >= self.interval:
+            self.save()
+
+    def save(self):
+        """Flush the written data and save the checkpoint sidecar file."""
+        self.writer.flush()
+        write_checkpoint(self.filename, {
+            "latest_id": self.latest_id, "count": self.count, "offset": self.offset})
+        self._num_pending = 0
+
+    def close(self):
+        """Save the checkpoint sidecar file and close the underlying writer."""
+        self.save()
+        self.writer.close()
+
+def _bulk_process_item(logger, output_filename, function, value, var_arg, resume,  # pylint: disable=too-many-arguments
+                       opener):
+    from tweepy import TweepError
+
+    # resume from the checkpoint of a previous processing if needed, dropping any torn record
+    checkpoint = None
+    if resume and path.exists(output_filename):
+        if truncate_torn_tail(output_filename):
+            logger.warning("truncated torn trailing record of: %s", output_filename)
+        checkpoint = _get_checkpoint(output_filename)
+
+    # process the input element with the provided function
+    try:
+        logger.info("processing: %s", value)
+        args = {var_arg: value}
+        if checkpoint is not None and checkpoint["latest_id"] is not None:
+            args.update({"since_id": checkpoint["latest_id"]})
+            logger.info("latest id processed: %d", checkpoint["latest_id"])
+        if resume:
+            with CheckpointWriter(opener(output_filename, append=True), output_filename,
+                                  checkpoint) as writer:
+                function(writer, **args)
+        else:
+            with opener(output_filename) as writer:
+                function(writer, **args)
+        return True
+    except TweepError:
+        logger.exception("exception while using the REST API")
+    return False
+
+def _bulk_process_record(logger, store, key, function, value, var_arg, resume):  # pylint: disable=too-many-arguments
+    from tweepy import TweepError
+
+    # resume from the latest id stored for the key if needed
+    checkpoint = store.get_checkpoint(key) if resume else None
+
+    # process the input element with the provided function, storing its output as a record
+    try:
+        logger.info("processing: %s", value)
+        args = {var_arg: value}
+        if checkpoint is not None and checkpoint["latest_id"] is not None:
+            args.update({"since_id": checkpoint["latest_id"]})
+            logger.info("latest id processed: %d", checkpoint["latest_id"])
+        from .shards import RecordWriter
+        writer = RecordWriter()
+        function(writer, **args)
+        if writer.count > 0 or writer.getvalue() or key not in store:
+            with PROFILER.timer("write"):
+                store.put(key, writer.getvalue(), writer.latest_id, writer.count)
+        return True
+    except TweepError:
+        logger.exception("exception while using the REST API")
+    return False
+
+def bulk_process(logger, output_dir, filename_tmpl, function, func_input, var_arg,  # pylint: disable=too-many-arguments
+                 resume=False, workers=1, opener=None, shards=0):
+    """Process a function in bulk using an iterable input and a variable argument.
+
+    If a number of shards is given, the outputs are packed into a shard store instead of files."""
+    if shards > 0 and opener is not None:
+        raise ValueError("ids in binary format can not be packed into shards")
+    opener = opener if opener is not None else open_writer
     if not path.exists(output_dir):
         makedirs(output_dir)
         logger.info("created output directory: %s", output_dir)
-    num_processed = 0
-    for basename, value in func_input:
-        output_filename = path.join(output_dir, filename_tmpl % basename)
-
-        # check if there is a previous processing and skip or resume it
-        latest_id = None
-        if path.exists(output_filename):
-            if not resume:
-                logger.warning("skipping existing file: %s", output_filename)
+    if shards > 0:
+        from .shards import open_shard_store
+        with open_shard_store(output_dir, shards) as store:
+            return _bulk_process(logger, output_dir, filename_tmpl, function, func_input,
+                                 var_arg, resume, workers, opener, store)
+    return _bulk_process(logger, output_dir, filename_tmpl, function, func_input, var_arg,
+                         resume, workers, opener, None)
+
+def _bulk_process(logger, output_dir, filename_tmpl, function, func_input, var_arg,  # pylint: disable=too-many-arguments
+                  resume, workers, opener, store):
+
+    # check if there is a previous processing and skip it if not resuming
+    def _gen_items():
+        for basename, value in func_input:
+            key = filename_tmpl % basename
+            if not resume and store is not None and key in store:
+                logger.warning("skipping existing record: %s", key)
                 continue
-            latest_id = _get_latest_id(output_filename)
-
-        # process the input element with the provided function
-        try:
-            logger.info("processing: %s", value)
-            args = {var_arg: value}
-            if latest_id is not None:
-                args.update({"since_id": latest_id})
-                logger.info("latest id processed: %d", latest_id)
-            with open(output_filename, "a" if resume else "w") as writer:
-                function(writer, **args)
-            num_processed += 1
-        except TweepError:
-            logger.exception("exception while using the REST API")
-    return num_processed
+            if not resume and store is None and path.exists(path.join(output_dir, key)):
+                logger.warning("skipping existing file: %s", path.join(output_dir, key))
+                continue
+            yield key, value
+
+    def _process_item(item):
+        if store is not None:
+            return _bulk_process_record(logger, store, item[0], function, item[1], var_arg,
+                                        resume)
+        return _bulk_process_item(logger, path.join(output_dir, item[0]), function, item[1],
+                                  var_arg, resume, opener)
+
+    # process the input elements sequentially or using a pool of worker threads
+    if workers > 1:
+        return _run_bounded(_process_item, _gen_items(), workers)
+    return sum(1 for item in _gen_items() if _process_item(item))
+
+def _run_bounded(function, items, workers):
+    # only a few items per worker are in flight, so the input is consumed as it is processed
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    slots = BoundedSemaphore(workers * BULK_ITEMS_PER_WORKER)
+    results, errors = [], []
+
+    def _on_result(result):
+        results.append(result)
+        slots.release()
+
+    def _on_error(error):
+        errors.append(error)
+        slots.release()
+
+    try:
+        for item in items:
+            slots.acquire()
+            if errors:
+                break
+            pool.apply_async(function, (item,), callback=_on_result, error_callback=_on_error)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        pool.join()
+    if errors:
+        raise errors[0]
+    return sum(1 for result in results if result)
 
 def log_tweep_error(logger, tweep_error):
     """Log a TweepError exception."""
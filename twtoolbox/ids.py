@@ -0,0 +1,192 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact binary format for Twitter ids module.
+
+A binary ids file is an 8-bytes header (magic "TTID", version, flags and two
+reserved bytes) followed by an array of little-endian unsigned 64-bit ids."""
+
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from os import path
+
+# module constants
+BINARY_MAGIC = b"TTID"
+BINARY_VERSION = 1
+BINARY_FLAG_SORTED = 0x01
+BINARY_HEADER = struct.Struct("<4sBBH")
+BINARY_ID_SIZE = 8
+BUFFER_SIZE = 8192
+IDSET_BUFFER_SIZE = 65536
+
+def _to_bytes(ids):
+    if sys.byteorder != "little":
+        ids = array("Q", ids)
+        ids.byteswap()
+    return ids.tobytes()
+
+def _unpack_header(data):
+    if len(data) != BINARY_HEADER.size:
+        raise ValueError("invalid binary ids file: header too short")
+    magic, version, flags, _ = BINARY_HEADER.unpack(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError("invalid binary ids file: bad magic number")
+    if version != BINARY_VERSION:
+        raise ValueError("unsupported binary ids file version: %d" % version)
+    return {"version": version, "sorted": bool(flags & BINARY_FLAG_SORTED)}
+
+class BinaryIdsWriter(object):
+    """Writer of Twitter ids in the compact binary format."""
+
+    def __init__(self, writer, sort=False, header=True):
+        self.writer = writer
+        self.sort = sort
+        self._buffer = array("Q")
+        if header:
+            flags = BINARY_FLAG_SORTED if sort else 0
+            self.writer.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_id(self, _id):
+        """Write a Twitter id, buffering it (or keeping it until closing if sorting)."""
+        self._buffer.append(_id)
+        if not self.sort and len(self._buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def write_ids(self, ids):
+        """Write an iterable (e.g. an array) of Twitter ids at once."""
+        self._buffer.extend(ids)
+        if not self.sort:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered ids to the underlying writer (unless sorting)."""
+        if self.sort:
+            return
+        self.writer.write(_to_bytes(self._buffer))
+        self._buffer = array("Q")
+        self.writer.flush()
+
+    def close(self):
+        """Write all remaining ids (sorted if needed) and close the underlying writer."""
+        if self.sort:
+            self.sort = False
+            self._buffer = array("Q", sorted(self._buffer))
+        self.flush()
+        self.writer.close()
+
+class IdSet(object):
+    """Compact set of Twitter ids, using 8 bytes per id instead of a Python set of ints.
+
+    Ids are kept in a sorted array searched with bisection, plus a small set of recently
+    added ids that is merged into the array when it grows beyond a fraction of it."""
+
+    def __init__(self, ids=None):
+        self.ids = array("Q", sorted(ids) if ids is not None else [])
+        self._recent = set()
+
+    def __len__(self):
+        return len(self.ids) + len(self._recent)
+
+    def __contains__(self, _id):
+        if _id in self._recent:
+            return True
+        idx = bisect_left(self.ids, _id)
+        return idx < len(self.ids) and self.ids[idx] == _id
+
+    def add(self, _id):
+        """Add a Twitter id to the set."""
+        if _id in self:
+            return
+        self._recent.add(_id)
+        if len(self._recent) >= max(IDSET_BUFFER_SIZE, len(self.ids) >> 3):
+            self.compact()
+
+    def compact(self):
+        """Merge the recently added ids into the sorted array."""
+        if self._recent:
+            self.ids = array("Q", merge(self.ids, sorted(self._recent)))
+            self._recent = set()
+
+    def get_sorted_ids(self):
+        """Get all the ids as a sorted array."""
+        self.compact()
+        return self.ids
+
+def open_binary_ids_writer(filename, append=False, sort=False):
+    """Open a binary ids writer for a file (or the standard output if no file is given)."""
+    if filename is None:
+        return BinaryIdsWriter(getattr(sys.stdout, "buffer", sys.stdout), sort=sort)
+    if append and path.exists(filename) and path.getsize(filename) > 0:
+        # appended ids can not be kept sorted, so clear the sorted flag of the existing file
+        with open(filename, "r+b") as updater:
+            header = _unpack_header(updater.read(BINARY_HEADER.size))
+            if header["sorted"]:
+                updater.seek(0)
+                updater.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, 0))
+        return BinaryIdsWriter(open(filename, "ab"), header=False)
+    return BinaryIdsWriter(open(filename, "wb"), sort=sort)
+
+def read_binary_header(filename):
+    """Read the header information (version, sorted) of a binary ids file."""
+    with open(filename, "rb") as reader:
+        return _unpack_header(reader.read(BINARY_HEADER.size))
+
+def read_binary_ids(filename):
+    """Memory-map a binary ids file as a read-only array of ids.
+
+    The ids are not copied in memory on little-endian platforms."""
+    with open(filename, "rb") as reader:
+        _unpack_header(reader.read(BINARY_HEADER.size))
+        num_ids = (path.getsize(filename) - BINARY_HEADER.size) // BINARY_ID_SIZE
+        if num_ids == 0:
+            return array("Q")
+        mapped = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+    ids = memoryview(mapped)[BINARY_HEADER.size:BINARY_HEADER.size + num_ids * BINARY_ID_SIZE]
+    if sys.byteorder != "little":
+        swapped = array("Q")
+        swapped.frombytes(ids.tobytes())
+        swapped.byteswap()
+        return swapped
+    return ids.cast("Q")
+
+def text_to_binary(input_filename, output_filename, sort=False):
+    """Convert a file of ids in plain text format into the binary format."""
+    num_ids = 0
+    with open(input_filename) as reader, \
+         open_binary_ids_writer(output_filename, sort=sort) as writer:
+        for line in reader:
+            line = line.strip()
+            if line:
+                writer.write_id(int(line))
+                num_ids += 1
+    return num_ids
+
+def binary_to_text(input_filename, output_filename):
+    """Convert a file of ids in binary format into the plain text format."""
+    ids = read_binary_ids(input_filename)
+    with open(output_filename, "w") as writer:
+        for _id in ids:
+            writer.write("%d\n" % _id)
+    return len(ids)
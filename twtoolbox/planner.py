@@ -0,0 +1,163 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Planner module, interleaving mixed bulk jobs across the rate limits of their endpoints."""
+
+import json
+import math
+import time
+import logging
+from threading import Thread
+from tweepy import TweepError
+from .helpers import init_logger, Session, RATE_LIMIT_WINDOW
+from . import tweets
+from . import users
+
+# module constants
+INTEGER_INPUTS = ("tweet_ids", "user_ids")
+STRING_INPUTS = ("screen_names", "queries")
+
+# endpoint, config section of the limit, results per request and maximum results of each job
+JOB_FUNCTIONS = {
+    "tweets.bulk_get_retweets": ("statuses/retweets/:id", None, 100, 100),
+    "tweets.bulk_get_timeline": ("statuses/user_timeline", "timeline", 200, 3200),
+    "tweets.bulk_search": ("search/tweets", "search", 100, 0),
+    "users.bulk_get_followers": ("followers/ids", "followers", 5000, 0),
+    "users.bulk_get_friends": ("friends/ids", "friends", 5000, 0),
+    "users.bulk_search": ("users/search", "search_users", 20, 1000),
+}
+
+# requests per credential and rate limit window, used until the API reports the budgets
+DEFAULT_RATE_LIMITS = {
+    "statuses/retweets/:id": 300,
+    "statuses/user_timeline": 1500,
+    "search/tweets": 450,
+    "followers/ids": 15,
+    "friends/ids": 15,
+    "users/search": 900,
+}
+
+# module logging
+LOGGER = logging.getLogger(__name__)
+init_logger(LOGGER)
+
+def _read_input(value, convert):
+    if not isinstance(value, str):
+        return [convert(el) for el in value]
+    with open(value) as reader:
+        return [convert(line.strip()) for line in reader
+                if line.strip() and not line.startswith("##")]
+
+def read_manifest(filename):
+    """Read a manifest of bulk jobs, a JSON list of bulk function names and their arguments.
+
+    Inputs (ids, screen names or queries) can be given as lists or as text files."""
+    with open(filename) as reader:
+        manifest = json.load(reader)
+    jobs = []
+    for spec in manifest:
+        spec = dict(spec)
+        name = spec.pop("function", None)
+        if name not in JOB_FUNCTIONS:
+            raise ValueError("unsupported bulk job function: %s" % name)
+        for key in INTEGER_INPUTS + STRING_INPUTS:
+            if spec.get(key) is not None:
+                spec[key] = _read_input(spec[key], int if key in INTEGER_INPUTS else str)
+        jobs.append({"function": name, "kwargs": spec})
+    return jobs
+
+def _get_requests_per_item(config, name):
+    _, section, per_request, max_results = JOB_FUNCTIONS[name]
+    limit = config.getint(section, "limit") if section is not None else 0
+    results = min(limit, max_results) if limit > 0 and max_results > 0 else limit or max_results
+    return max(int(math.ceil(float(results) / per_request)), 1)
+
+def _estimate_seconds(num_requests, budget, default_limit, now):
+    limit = budget.get("limit") or default_limit
+    remaining = budget.get("remaining", limit)
+    reset = budget.get("reset") or now + RATE_LIMIT_WINDOW
+    if num_requests <= remaining:
+        return 0.0
+    num_windows = int(math.ceil(float(num_requests - remaining) / limit))
+    return max(reset - now, 0) + (num_windows - 1) * RATE_LIMIT_WINDOW
+
+def _format_duration(seconds):
+    return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+def estimate_plan(jobs, session):
+    """Estimate the requests and rate-limited time of the jobs, grouped by endpoint."""
+    pools = {"users/search": session.oauth_pool}  # only OAuth supported for users/search
+    budgets = {}
+    for pool in set([session.app_auth_pool, session.oauth_pool]):
+        try:
+            pool.refresh_budgets()
+        except TweepError as err:
+            LOGGER.warning("could not get the rate limit status: %s", err)
+    plan = {}
+    for job in jobs:
+        endpoint = JOB_FUNCTIONS[job["function"]][0]
+        lane = plan.setdefault(endpoint, {"endpoint": endpoint, "jobs": [], "items": 0,
+                                          "requests": 0})
+        num_items = sum(len(job["kwargs"].get(key) or [])
+                        for key in INTEGER_INPUTS + STRING_INPUTS)
+        lane["jobs"].append(job)
+        lane["items"] += num_items
+        lane["requests"] += num_items * _get_requests_per_item(session.config, job["function"])
+    now = time.time()
+    for endpoint, lane in plan.items():
+        pool = pools.get(endpoint, session.app_auth_pool)
+        if pool not in budgets:
+            budgets[pool] = pool.get_budgets()
+        lane["seconds"] = _estimate_seconds(lane["requests"], budgets[pool].get(endpoint, {}),
+                                            DEFAULT_RATE_LIMITS[endpoint] * len(pool.keys), now)
+    return sorted(plan.values(), key=lambda lane: -lane["seconds"])
+
+def _run_lane(lane):
+    for job in lane["jobs"]:
+        module_name, function_name = job["function"].split(".")
+        function = getattr(tweets if module_name == "tweets" else users, function_name)
+        try:
+            function(**job["kwargs"])
+        except Exception as excp:  # pylint: disable=broad-except
+            LOGGER.error("bulk job %s failed: %s", job["function"], excp)
+
+def run_manifest(filename, dry_run=False):
+    """Run a manifest of bulk jobs, interleaving the jobs of different API endpoints."""
+    LOGGER.info("run_manifest() starting")
+
+    # estimate the time of the jobs of each endpoint, limited by its own rate limit budget
+    jobs = read_manifest(filename)
+    plan = estimate_plan(jobs, Session())
+    for lane in plan:
+        LOGGER.info("%s: %d job(s), %d item(s), up to %d request(s), ~%s", lane["endpoint"],
+                    len(lane["jobs"]), lane["items"], lane["requests"],
+                    _format_duration(lane["seconds"]))
+    if plan:
+        LOGGER.info("estimated time: ~%s interleaved (~%s sequentially)",
+                    _format_duration(max(lane["seconds"] for lane in plan)),
+                    _format_duration(sum(lane["seconds"] for lane in plan)))
+
+    # run the jobs of each endpoint in its own thread, so rate limit waits do not block others
+    if not dry_run:
+        started = time.time()
+        threads = [Thread(target=_run_lane, args=(lane,), name=lane["endpoint"]) for lane in plan]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        LOGGER.info("ran %d job(s) in %s", len(jobs), _format_duration(time.time() - started))
+
+    # finished
+    LOGGER.info("run_manifest() finished")
@@ -0,0 +1,204 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Packed shard store for bulk output module.
+
+Records (the output of each bulk input) are appended to a fixed number of shard files,
+with an SQLite index from each record key (the filename it would have in the per-file
+layout) to its shard, offset and length. Compressed records are complete gzip members
+or zstd frames, so the records of a key can be concatenated into a valid file."""
+
+import io
+import sqlite3
+import zlib
+from threading import Lock
+from os import path, makedirs
+from .writers import get_compression, compress_data
+
+# module constants
+INDEX_FILENAME = "shards.db"
+SHARD_FILENAME = "shard-%03d.dat"
+DEFAULT_NUM_SHARDS = 16
+COMMIT_INTERVAL = 1000
+
+class RecordWriter(object):
+    """Writer that buffers the output of a bulk input in memory, for storing it as a record."""
+
+    def __init__(self):
+        self.latest_id = None
+        self.count = 0
+        self._buffer = io.BytesIO()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def write(self, data):
+        """Buffer text data."""
+        self._buffer.write(data.encode("utf-8"))
+
+    def track_id(self, obj_id):
+        """Account a written Twitter object id."""
+        if self.latest_id is None or obj_id > self.latest_id:
+            self.latest_id = obj_id
+        self.count += 1
+
+    def flush(self):
+        """Nothing to flush, data is kept until stored."""
+
+    def getvalue(self):
+        """Get the buffered data."""
+        return self._buffer.getvalue()
+
+class ShardStore(object):
+    """Store of bulk output records packed into shard files, indexed by key."""
+
+    def __init__(self, directory, num_shards=DEFAULT_NUM_SHARDS):
+        if not path.exists(directory):
+            makedirs(directory)
+        self.directory = directory
+        self._num_pending = 0
+        self._index_lock = Lock()
+        self._conn = sqlite3.connect(path.join(directory, INDEX_FILENAME), timeout=60,
+                                     check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records (key TEXT NOT NULL, shard INTEGER NOT NULL, "
+            "offset INTEGER NOT NULL, length INTEGER NOT NULL, latest_id INTEGER, "
+            "count INTEGER NOT NULL DEFAULT 0)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS records_key ON records (key)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('num_shards', ?)",
+                           (num_shards,))
+        self._conn.commit()
+        self.num_shards = self._conn.execute(
+            "SELECT value FROM meta WHERE name = 'num_shards'").fetchone()[0]
+        self._files = [None] * self.num_shards
+        self._locks = [Lock() for _ in range(self.num_shards)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, key):
+        with self._index_lock:
+            return self._conn.execute(
+                "SELECT 1 FROM records WHERE key = ? LIMIT 1", (key,)).fetchone() is not None
+
+    def _get_filename(self, shard):
+        return path.join(self.directory, SHARD_FILENAME % shard)
+
+    def get_checkpoint(self, key):
+        """Get the latest Twitter object id and number of objects stored for a key."""
+        with self._index_lock:
+            latest_id, count = self._conn.execute(
+                "SELECT MAX(latest_id), COALESCE(SUM(count), 0) FROM records WHERE key = ?",
+                (key,)).fetchone()
+        return {"latest_id": latest_id, "count": count}
+
+    def put(self, key, data, latest_id=None, count=0):
+        """Append a record for a key (compressed according to its extension) to its shard."""
+        data = compress_data(data, get_compression(key)) if data else data
+        shard = zlib.crc32(key.encode("utf-8")) % self.num_shards
+        with self._locks[shard]:
+            if self._files[shard] is None:
+                self._files[shard] = open(self._get_filename(shard), "ab")
+            writer = self._files[shard]
+            writer.seek(0, io.SEEK_END)
+            offset = writer.tell()
+            writer.write(data)
+            writer.flush()
+        # the data is written before it is indexed, so a crash can only leave unindexed data
+        with self._index_lock:
+            self._conn.execute(
+                "INSERT INTO records (key, shard, offset, length, latest_id, count) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (key, shard, offset, len(data), latest_id, count))
+            self._num_pending += 1
+            if self._num_pending >= COMMIT_INTERVAL:
+                self._conn.commit()
+                self._num_pending = 0
+
+    def read(self, key):
+        """Read all the data stored for a key (empty if not found)."""
+        with self._index_lock:
+            records = self._conn.execute(
+                "SELECT shard, offset, length FROM records WHERE key = ? ORDER BY rowid",
+                (key,)).fetchall()
+        chunks = []
+        for shard, offset, length in records:
+            with open(self._get_filename(shard), "rb") as reader:
+                reader.seek(offset)
+                chunks.append(reader.read(length))
+        return b"".join(chunks)
+
+    def keys(self):
+        """Get all the stored keys, sorted."""
+        with self._index_lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT key FROM records ORDER BY key")]
+
+    def gen_items(self):
+        """Generate all the stored (key, data) records, sorted by key."""
+        with self._index_lock:
+            self._conn.commit()
+        conn = sqlite3.connect(path.join(self.directory, INDEX_FILENAME), timeout=60)
+        readers = {}
+        try:
+            for key, shard, offset, length in conn.execute(
+                    "SELECT key, shard, offset, length FROM records ORDER BY key, rowid"):
+                if shard not in readers:
+                    readers[shard] = open(self._get_filename(shard), "rb")
+                readers[shard].seek(offset)
+                yield key, readers[shard].read(length)
+        finally:
+            conn.close()
+            for reader in readers.values():
+                reader.close()
+
+    def close(self):
+        """Commit the index and close the shard files."""
+        with self._index_lock:
+            self._conn.commit()
+            self._conn.close()
+        for writer in self._files:
+            if writer is not None:
+                writer.close()
+
+def open_shard_store(directory, num_shards=DEFAULT_NUM_SHARDS):
+    """Open (or create) the shard store of a directory."""
+    return ShardStore(directory, num_shards=num_shards)
+
+def export_shards(input_dir, output_dir):
+    """Export a packed shard store of bulk output into one file per input."""
+    if not path.exists(output_dir):
+        makedirs(output_dir)
+    num_files = 0
+    writer, last_key = None, None
+    with open_shard_store(input_dir) as store:
+        try:
+            for key, data in store.gen_items():
+                if key != last_key:
+                    if writer is not None:
+                        writer.close()
+                    writer, last_key = open(path.join(output_dir, key), "wb"), key
+                    num_files += 1
+                writer.write(data)
+        finally:
+            if writer is not None:
+                writer.close()
+    return num_files
@@ -16,58 +16,389 @@
 """Twitter Public Streaming API module."""
 
 import logging
+import re
 import json
 import time
+import random
+from threading import Thread, Lock, Event
+from queue import Queue, Full, Empty
 from tweepy import StreamListener, Stream
-from .helpers import init_logger, read_config, get_oauth_api
+from .helpers import init_logger, read_config, get_oauth_api, get_credential_sections
+from .helpers import CONFIG_CREDENTIALS, METRICS, PROFILER
 from .helpers import ensure_at_least_one
 
 # module constants
-RETRY_INTERVAL = 3
+NETWORK_BACKOFF_STEP = 0.25
+NETWORK_BACKOFF_MAX = 16
+HTTP_BACKOFF_START = 5
+HTTP_BACKOFF_MAX = 320
+RATE_LIMIT_BACKOFF_START = 60
+RATE_LIMIT_BACKOFF_MAX = 960
+BACKOFF_JITTER = 0.25
+WRITE_BATCH_SIZE = 1000
+WRITER_CHECK_INTERVAL = 1
+RAW_TWEET_PREFIX = '{"created_at":'
+FILTER_MAX_FOLLOW = 5000
+FILTER_MAX_TRACK = 400
+FILTER_MAX_LOCATIONS = 25
+DEDUP_GENERATION_SIZE = 100000
+
+_MESSAGE_ID_PATTERN = re.compile(r'"id":(\d+)')
 
 # module logging
 LOGGER = logging.getLogger(__name__)
 init_logger(LOGGER)
 
+class ReconnectBackoff(object):
+    """Reconnection delays following the Streaming API schedules, with random jitter.
+
+    Network errors back off linearly, HTTP errors exponentially and rate limiting
+    errors (420) exponentially from a longer start."""
+
+    def __init__(self):
+        self.error = None
+        self.attempts = 0
+
+    def reset(self):
+        """Reset the schedule after a successful connection."""
+        self.error = None
+        self.attempts = 0
+
+    def get_delay(self, error):
+        """Get the delay in seconds for the next reconnection after an error."""
+        if error != self.error:
+            self.error = error
+            self.attempts = 0
+        self.attempts += 1
+        if error == "network":
+            delay = min(NETWORK_BACKOFF_STEP * self.attempts, NETWORK_BACKOFF_MAX)
+        elif error == "http":
+            delay = min(HTTP_BACKOFF_START * 2 ** (self.attempts - 1), HTTP_BACKOFF_MAX)
+        else:
+            delay = min(RATE_LIMIT_BACKOFF_START * 2 ** (self.attempts - 1),
+                        RATE_LIMIT_BACKOFF_MAX)
+        return delay + random.uniform(0, delay * BACKOFF_JITTER)
+
+class ShardGroup(object):
+    """Shared state of sharded streams: a duplicate Tweets filter and the total limit.
+
+    The filter remembers the ids of the current and previous generations of Tweets,
+    so its memory is bounded to twice the generation size."""
+
+    def __init__(self, limit=0, generation_size=DEDUP_GENERATION_SIZE):
+        self.limit = limit
+        self.generation_size = generation_size
+        self.num_accepted = 0
+        self.num_duplicates = 0
+        self.finished = Event()
+        self._current = set()
+        self._previous = set()
+        self._lock = Lock()
+
+    def accept(self, message_id):
+        """Check if a Tweet should be written, i.e. it is not a duplicate nor over the limit."""
+        with self._lock:
+            if self.finished.is_set():
+                return False
+            if message_id in self._current or message_id in self._previous:
+                self.num_duplicates += 1
+                return False
+            self._current.add(message_id)
+            if len(self._current) >= self.generation_size:
+                self._previous = self._current
+                self._current = set()
+            self.num_accepted += 1
+            if self.num_accepted == self.limit:
+                self.finished.set()
+            return True
+
+class StreamWriterError(Exception):
+    """Error writing the output of a stream, which reconnecting can not fix."""
+
+class _LockedWriter(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self._lock = Lock()
+
+    def write(self, data):
+        with self._lock:
+            self.writer.write(data)
+
+    def flush(self):
+        with self._lock:
+            self.writer.flush()
+
+def _get_message_id(message):
+    if isinstance(message, dict):
+        return message["id"]
+    return int(_MESSAGE_ID_PATTERN.search(message).group(1))
+
+def _format_message(message):
+    if isinstance(message, dict):
+        return "%s\n" % json.dumps(message, separators=(",", ":"))
+    return "%s\n" % message
+
 class PassThroughStreamListener(StreamListener):
-    """Stream Listener that passes incoming messages directly to a writer."""
+    """Stream Listener that passes incoming messages directly to a writer.
 
-    def __init__(self, writer, limit=0, **kwargs):
+    In raw mode, incoming Tweets are written exactly as received without being parsed.
+    Only control messages (deletes, limit notices, warnings, etc) are parsed."""
+
+    def __init__(self, writer, limit=0, raw=False, group=None, name="stream", **kwargs):  # pylint: disable=too-many-arguments
         super(PassThroughStreamListener, self).__init__(**kwargs)
         self.writer = writer
         self.limit = limit
+        self.raw = raw
+        self.group = group
+        self.name = name
         self.num_written = 0
+        self._rate_started = time.time()
+        self._rate_written = 0
+        self.error = None
+        self.backoff = ReconnectBackoff()
+        self.num_reconnects = 0
+        self.downtime = 0.0
+        self._disconnected_at = None
 
-    def on_status(self, status):
-        """Write an incoming Tweet to the writer."""
-        self.writer.write("%s\n" % json.dumps(status._json, separators=(",", ":")))  # pylint: disable=protected-access
-        self.num_written += 1
+    def _count_written(self, num_messages, num_bytes):
+        self.num_written += num_messages
+        METRICS.inc("stream_tweets_total", num_messages, stream=self.name)
+        METRICS.inc("bytes_written_total", num_bytes)
+        now = time.time()
+        if now - self._rate_started >= 1:
+            METRICS.set("stream_tweets_per_second", (self.num_written - self._rate_written) /
+                        (now - self._rate_started), stream=self.name)
+            self._rate_started = now
+            self._rate_written = self.num_written
+
+    def _emit(self, message):
+        with PROFILER.timer("serialize"):
+            data = _format_message(message)
+        with PROFILER.timer("write"):
+            try:
+                self.writer.write(data)
+            except Exception as excp:  # pylint: disable=broad-except
+                raise StreamWriterError("stream writer failed: %s" % excp)
+        self._count_written(1, len(data))
         if self.num_written == self.limit:
             return False
         return True
 
+    def _process(self, message):
+        if self.group is None:
+            return self._emit(message)
+        if not self.group.accept(_get_message_id(message)):
+            return not self.group.finished.is_set()
+        return self._emit(message) and not self.group.finished.is_set()
+
+    @property
+    def stopped(self):
+        """Whether the stream was stopped because its shard group finished."""
+        return self.group is not None and self.group.finished.is_set()
+
+    def on_data(self, raw_data):
+        """Write an incoming raw Tweet to the writer if in raw mode, otherwise parse it."""
+        if self.raw and raw_data.startswith(RAW_TWEET_PREFIX):
+            return self._process(raw_data.rstrip())
+        with PROFILER.timer("parse"):
+            return super(PassThroughStreamListener, self).on_data(raw_data)
+
+    def on_status(self, status):
+        """Write an incoming Tweet to the writer."""
+        return self._process(status._json)  # pylint: disable=protected-access
+
+    def on_connect(self):
+        """Handle stream (re)connections."""
+        self.backoff.reset()
+        if self._disconnected_at is not None:
+            downtime = time.time() - self._disconnected_at
+            self._disconnected_at = None
+            self.num_reconnects += 1
+            self.downtime += downtime
+            METRICS.inc("stream_reconnects_total", stream=self.name)
+            METRICS.inc("stream_downtime_seconds_total", downtime, stream=self.name)
+            LOGGER.info("stream reconnected after %.1f seconds (%d reconnects, %.1f seconds down)",
+                        downtime, self.num_reconnects, self.downtime)
+
+    def on_disconnected(self):
+        """Record the start of a stream disconnection."""
+        if self._disconnected_at is None:
+            self._disconnected_at = time.time()
+
     def on_error(self, status_code):
-        """Handle stream errors."""
+        """Handle stream HTTP errors, stopping the stream to reconnect with backoff."""
         if status_code == 420:
-            LOGGER.error("too many connection attempts, stopping stream")
+            LOGGER.warning("too many connection attempts (HTTP 420)")
+            self.error = "rate_limit"
+        else:
+            LOGGER.warning("stream HTTP error %d", status_code)
+            self.error = "http"
+        return False
+
+    def on_timeout(self):
+        """Handle stalled streams, stopping the stream to reconnect with backoff."""
+        LOGGER.warning("stream stalled, no data received within the timeout")
+        self.error = "network"
+        return False
+
+    def on_warning(self, notice):
+        """Handle stall warnings."""
+        LOGGER.warning("stream warning: %s", notice.get("message", notice))
+
+    def on_disconnect(self, notice):
+        """Handle disconnect messages."""
+        LOGGER.warning("stream disconnect message: %s", notice.get("reason", notice))
+
+    def close(self):
+        """Finish writing incoming messages."""
+
+class QueuedStreamListener(PassThroughStreamListener):
+    """Stream Listener that passes incoming messages to a writer through a bounded queue.
+
+    Messages are written in batches by a dedicated thread, so slow writes do not stall the
+    network reads. If the queue is full, messages are dropped if asked, otherwise reading
+    blocks until there is room in the queue (backpressure). If writing fails, the error is
+    raised on the next incoming message and when closing, as the synchronous listener does."""
+
+    _SENTINEL = object()
+
+    def __init__(self, writer, limit=0, raw=False, group=None, name="stream", queue_size=1000,  # pylint: disable=too-many-arguments
+                 drop=False, **kwargs):
+        super(QueuedStreamListener, self).__init__(writer, limit=limit, raw=raw, group=group,
+                                                   name=name, **kwargs)
+        self.drop = drop
+        self.num_queued = 0
+        self.num_dropped = 0
+        self.num_blocked = 0
+        self.max_depth = 0
+        self.writer_error = None
+        self._queue = Queue(maxsize=queue_size)
+        self._thread = Thread(target=self._run_writer, name="stream-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Current number of messages waiting in the queue."""
+        return self._queue.qsize()
+
+    def _run_writer(self):
+        try:
+            self._write_batches()
+        except Exception as excp:  # pylint: disable=broad-except
+            LOGGER.error("stream writer failed: %s", excp)
+            self.writer_error = excp
+
+    def _write_batches(self):
+        finished = False
+        while not finished:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if batch[-1] is self._SENTINEL:
+                batch.pop()
+                finished = True
+            if batch:
+                with PROFILER.timer("serialize"):
+                    data = "".join(_format_message(message) for message in batch)
+                with PROFILER.timer("write"):
+                    self.writer.write(data)
+                self._count_written(len(batch), len(data))
+
+    def _check_writer(self):
+        if self.writer_error is not None:
+            raise StreamWriterError("stream writer failed: %s" % self.writer_error)
+        if not self._thread.is_alive():
+            raise StreamWriterError("stream writer thread is not running")
+
+    def _put(self, message):
+        # block until there is room in the queue, as long as the writer thread is running
+        while True:
+            try:
+                self._queue.put(message, timeout=WRITER_CHECK_INTERVAL)
+                return
+            except Full:
+                self._check_writer()
+
+    def _emit(self, message):
+        self._check_writer()
+        try:
+            self._queue.put_nowait(message)
+        except Full:
+            if self.drop:
+                self.num_dropped += 1
+                METRICS.inc("stream_dropped_total", stream=self.name)
+                return True
+            self.num_blocked += 1
+            METRICS.inc("stream_blocked_total", stream=self.name)
+            with PROFILER.timer("queue_wait"):
+                self._put(message)
+        self.num_queued += 1
+        depth = self._queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        METRICS.set("stream_queue_depth", depth, stream=self.name)
+        if self.num_queued == self.limit:
             return False
         return True
 
-def _get_stream(writer, config, limit=0):
-    api = get_oauth_api(config)
-    listener = PassThroughStreamListener(writer, limit=limit)
-    return Stream(auth=api.auth, listener=listener)
+    def close(self):
+        """Write all the queued messages and stop the writer thread, raising any write error."""
+        if self._thread.is_alive():
+            try:
+                self._put(self._SENTINEL)
+            except Exception:  # pylint: disable=broad-except
+                pass  # the writer thread stopped, its error is raised below
+            self._thread.join()
+        elif self.writer_error is None:
+            return  # already closed
+        if self.writer_error is not None:
+            raise self.writer_error
+        LOGGER.info("stream queue: %d written, %d dropped, %d blocked, max depth %d",
+                    self.num_written, self.num_dropped, self.num_blocked, self.max_depth)
+
+def _get_stream(writer, config, limit=0, section=CONFIG_CREDENTIALS, group=None, name="stream"):  # pylint: disable=too-many-arguments
+    api = get_oauth_api(config, section)
+    raw = config.getboolean("streaming", "raw")
+    queue_size = config.getint("streaming", "queue_size")
+    if queue_size > 0:
+        listener = QueuedStreamListener(writer, limit=limit, raw=raw, group=group, name=name,
+                                        queue_size=queue_size,
+                                        drop=config.getboolean("streaming", "drop"))
+    else:
+        listener = PassThroughStreamListener(writer, limit=limit, raw=raw, group=group,
+                                             name=name)
+    return Stream(auth=api.auth, listener=listener,
+                  timeout=config.getint("streaming", "stall_timeout"))
 
-def _safe_stream_run(func, *args, **kwargs):
-    running = True
-    while running:
+def _safe_stream_run(stream, func, *args, **kwargs):
+    listener = stream.listener
+    while True:
+        listener.error = None
         try:
             func(*args, **kwargs)
-            running = False
+        except StreamWriterError:
+            raise  # only connection problems are fixed by reconnecting
         except Exception as excp:  # pylint: disable=broad-except
             LOGGER.warning(excp)
-            LOGGER.info("reconnecting stream ...")
-            time.sleep(RETRY_INTERVAL)
+            listener.error = "network"
+        if listener.error is None or listener.stopped:
+            break
+        listener.on_disconnected()
+        delay = listener.backoff.get_delay(listener.error)
+        LOGGER.info("reconnecting stream in %.2f seconds ...", delay)
+        time.sleep(delay)
+
+def _run_stream(stream, func, *args, **kwargs):
+    try:
+        _safe_stream_run(stream, func, *args, **kwargs)
+    finally:
+        stream.listener.close()
+        if stream.listener.num_reconnects:
+            LOGGER.info("stream reconnected %d times, %.1f seconds down in total",
+                        stream.listener.num_reconnects, stream.listener.downtime)
 
 def get_sample(writer):
     """Get hydrated Tweet-objects from the sample Streaming API endpoint."""
@@ -77,22 +408,76 @@ def get_sample(writer):
     config = read_config()
     limit = config.getint("sample", "limit")
     stream = _get_stream(writer, config, limit=limit)
-    _safe_stream_run(stream.sample)
+    _run_stream(stream, stream.sample, stall_warnings=True)
 
     # finished
     LOGGER.info("get_sample() finished")
 
-def get_filter(writer, follow=None, track=None, locations=None):
+def _get_num_shards(shards, follow, track, locations):
+    num_boxes = len(locations) // 4 if locations else 0
+    return max(shards,
+               -(-len(follow or []) // FILTER_MAX_FOLLOW),
+               -(-len(track or []) // FILTER_MAX_TRACK),
+               -(-num_boxes // FILTER_MAX_LOCATIONS))
+
+def _split_shards(values, shards, size=1):
+    if not values:
+        return [None] * shards
+    items = [values[idx:idx + size] for idx in range(0, len(values), size)]
+    return [[value for item in items[shard::shards] for value in item] or None
+            for shard in range(shards)]
+
+def _run_sharded_filter(writer, config, limit, shards, follow, track, locations):
+    sections = get_credential_sections(config)
+    if shards > len(sections):
+        LOGGER.warning("more shards (%d) than credentials (%d), connections sharing "
+                       "credentials may be disconnected", shards, len(sections))
+    group = ShardGroup(limit=limit)
+    writer = _LockedWriter(writer)
+    streams, threads = [], []
+    for shard, (shard_follow, shard_track, shard_locations) in enumerate(zip(
+            _split_shards(follow, shards), _split_shards(track, shards),
+            _split_shards(locations, shards, size=4))):
+        if not (shard_follow or shard_track or shard_locations):
+            continue
+        stream = _get_stream(writer, config, section=sections[shard % len(sections)],
+                             group=group, name="shard-%d" % shard)
+        thread = Thread(target=_run_stream, name="stream-shard-%d" % shard,
+                        args=(stream, stream.filter),
+                        kwargs={"follow": shard_follow, "track": shard_track,
+                                "locations": shard_locations, "stall_warnings": True})
+        thread.daemon = True
+        thread.start()
+        streams.append(stream)
+        threads.append(thread)
+    LOGGER.info("running %d filter stream shards", len(threads))
+
+    # wait until all the shards finish or the total limit is reached
+    for thread in threads:
+        while thread.is_alive() and not group.finished.is_set():
+            thread.join(1)
+    for stream in streams:
+        stream.disconnect()
+        stream.listener.close()
+    LOGGER.info("%d Tweets written, %d duplicates removed",
+                group.num_accepted, group.num_duplicates)
+
+def get_filter(writer, follow=None, track=None, locations=None, shards=1):
     """Get hydrated Tweet-objects from the filter Streaming API endpoint."""
     LOGGER.info("get_filter() starting")
     ensure_at_least_one(follow=follow, track=track, locations=locations)
     follow = [str(f) for f in follow] if follow else None
 
-    # initialize a Streaming API object and run the endpoint
+    # initialize the Streaming API objects (one per shard) and run the endpoint
     config = read_config()
     limit = config.getint("filter", "limit")
-    stream = _get_stream(writer, config, limit=limit)
-    _safe_stream_run(stream.filter, follow=follow, track=track, locations=locations)
+    shards = _get_num_shards(shards, follow, track, locations)
+    if shards > 1:
+        _run_sharded_filter(writer, config, limit, shards, follow, track, locations)
+    else:
+        stream = _get_stream(writer, config, limit=limit)
+        _run_stream(stream, stream.filter, follow=follow, track=track, locations=locations,
+                    stall_warnings=True)
 
     # finished
     LOGGER.info("get_filter() finished")
@@ -105,7 +490,7 @@ def get_firehose(writer):
     config = read_config()
     limit = config.getint("firehose", "limit")
     stream = _get_stream(writer, config, limit=limit)
-    _safe_stream_run(stream.firehose)
+    _run_stream(stream, stream.firehose)
 
     # finished
     LOGGER.info("get_firehose() finished")
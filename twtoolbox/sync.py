@@ -0,0 +1,139 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental timeline synchronization state module."""
+
+import math
+import sqlite3
+import time
+from threading import Lock
+from os import path
+
+# module constants
+STATE_FILENAME = "sync-state.db"
+INSERT_BATCH_SIZE = 10000
+RATE_WINDOW = 30 * 24 * 60 * 60
+TWITTER_EPOCH_MS = 1288834974657
+
+def get_tweet_timestamp(tweet_id):
+    """Get the creation time (seconds since the epoch) encoded in a Tweet (Snowflake) id."""
+    return ((tweet_id >> 22) + TWITTER_EPOCH_MS) / 1000.0
+
+class TimelineSyncState(object):
+    """On-disk index of the per-user timeline sync state: since_id, fetch times and Tweet rate.
+
+    The Tweet rate (per second) is estimated from the Tweets created within the last rate
+    window on the first fetch, and updated with an exponential moving average afterwards.
+    A user is due again once the expected number of new Tweets reaches a target, within
+    minimum and maximum intervals, so active users are refreshed often and dormant rarely."""
+
+    def __init__(self, filename, min_interval=0, max_interval=0, target_tweets=1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_tweets = target_tweets
+        self._lock = Lock()
+        self._conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS timelines (user_id INTEGER PRIMARY KEY, "
+            "since_id INTEGER NOT NULL DEFAULT 0, fetched REAL, next_fetch REAL NOT NULL, "
+            "rate REAL, num_tweets INTEGER NOT NULL DEFAULT 0)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS timelines_next_fetch ON timelines (next_fetch)")
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def gen_due_users(self, user_ids, max_users=0, now=None):
+        """Generate the given user ids due for syncing, new and most active users first."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS sync_input "
+                               "(user_id INTEGER PRIMARY KEY)")
+            self._conn.execute("DELETE FROM sync_input")
+            batch = []
+            for user_id in user_ids:
+                batch.append((user_id,))
+                if len(batch) == INSERT_BATCH_SIZE:
+                    self._insert_input(batch)
+                    batch = []
+            self._insert_input(batch)
+            due = self._conn.execute(
+                "SELECT timelines.user_id FROM sync_input JOIN timelines USING (user_id) "
+                "WHERE next_fetch <= ? ORDER BY rate IS NOT NULL, rate DESC%s" % (
+                    " LIMIT %d" % max_users if max_users > 0 else ""), (now,)).fetchall()
+            self._conn.commit()
+        for row in due:
+            yield row[0]
+
+    def _insert_input(self, batch):
+        self._conn.executemany("INSERT OR IGNORE INTO sync_input (user_id) VALUES (?)", batch)
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO timelines (user_id, next_fetch) VALUES (?, 0)", batch)
+
+    def get_since_id(self, user_id):
+        """Get the id of the latest synced Tweet of a user (0 if never synced)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT since_id FROM timelines WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def _get_interval(self, rate):
+        if rate <= 0:
+            return self.max_interval
+        interval = self.target_tweets / rate
+        if self.max_interval > 0:
+            interval = min(interval, self.max_interval)
+        return max(interval, self.min_interval)
+
+    def update(self, user_id, tweet_ids, now=None):
+        """Record a sync of a user timeline with the ids of the new Tweets, scheduling the next."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT since_id, fetched, rate FROM timelines WHERE user_id = ?",
+                (user_id,)).fetchone()
+            since_id, fetched, rate = row if row else (0, None, None)
+            if fetched is None or rate is None:
+                rate = sum(1 for _id in tweet_ids
+                           if get_tweet_timestamp(_id) >= now - RATE_WINDOW) / float(RATE_WINDOW)
+            else:
+                elapsed = max(now - fetched, 1.0)
+                weight = 1.0 - math.exp(-elapsed / RATE_WINDOW)
+                rate = weight * len(tweet_ids) / elapsed + (1.0 - weight) * rate
+            since_id = max([since_id] + list(tweet_ids))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO timelines (user_id, since_id, fetched, next_fetch, rate, "
+                "num_tweets) VALUES (?, ?, ?, ?, ?, COALESCE((SELECT num_tweets FROM timelines "
+                "WHERE user_id = ?), 0) + ?)",
+                (user_id, since_id, now, now + self._get_interval(rate), rate, user_id,
+                 len(tweet_ids)))
+            self._conn.commit()
+
+    def close(self):
+        """Commit the pending changes and close the state index."""
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+def open_sync_state(config, output_dir):
+    """Open the timeline sync state index of an output directory, configured in [sync]."""
+    return TimelineSyncState(path.join(output_dir, STATE_FILENAME),
+                             min_interval=config.getint("sync", "min_interval"),
+                             max_interval=config.getint("sync", "max_interval"),
+                             target_tweets=config.getint("sync", "target_tweets"))
@@ -16,10 +16,15 @@
 """Twitter Tweet-objects module."""
 
 import logging
+from functools import partial
+from os import path, makedirs
 from tweepy import TweepError
-from .helpers import init_logger, read_config, get_app_auth_api, get_oauth_api
+from .helpers import init_logger, Session, get_session
 from .helpers import ensure_at_least_one, ensure_only_one, gen_chunks, bulk_process
 from .helpers import write_objs, log_tweep_error
+from .cache import open_cache
+from .sync import open_sync_state
+from .writers import get_compression_extension
 
 # module constants
 LOOKUP_STATUSES_PER_REQUEST = 100
@@ -31,33 +36,44 @@ SEARCH_COUNT = 100
 LOGGER = logging.getLogger(__name__)
 init_logger(LOGGER)
 
-def get_hydrated(writer, tweet_ids):
+def get_hydrated(writer, tweet_ids, session=None):
     """Get hydrated Tweet-objects from a list of Tweet ids."""
     LOGGER.info("get_hydrated() starting")
 
-    # initialize config and Twitter API
-    config = read_config()
-    api = get_oauth_api(config)  # OAuth gives more capacity for the statuses/lookup API
+    # initialize config, Twitter API and hydration cache
+    session = get_session(session)
+    config = session.config
+    api = session.oauth_pool  # OAuth gives more capacity for the statuses/lookup API
+    cache = open_cache(config, "tweets")
 
-    # process Tweet ids, storing returned Tweets in JSON format
+    # process Tweet ids not found in the cache, storing returned Tweets in JSON format
     num_tweets = 0
+    if cache is not None:
+        tweet_ids = cache.gen_misses(writer, tweet_ids)
     for chunk in gen_chunks(tweet_ids, size=LOOKUP_STATUSES_PER_REQUEST):
         try:
-            num_tweets = write_objs(writer, api.statuses_lookup, {"id_": chunk[0]})
+            num_tweets += write_objs(writer, api.statuses_lookup, {"id_": chunk[0]},
+                                     callback=cache.put if cache is not None else None)
         except TweepError as err:
             log_tweep_error(LOGGER, err)
-    LOGGER.info("downloaded %d Tweet(s)", num_tweets)
+    if cache is not None:
+        cache.close()
+        num_tweets += cache.num_hits
+        LOGGER.info("downloaded %d Tweet(s), cache: %d hit(s), %d miss(es)",
+                    num_tweets, cache.num_hits, cache.num_misses)
+    else:
+        LOGGER.info("downloaded %d Tweet(s)", num_tweets)
 
     # finished
     LOGGER.info("get_hydrated() finished")
 
-def get_retweets(writer, tweet_id):
+def get_retweets(writer, tweet_id, session=None):
     """Get hydrated Retweet-objects for a given Tweet id."""
     LOGGER.info("get_retweets() starting")
 
     # initialize config and Twitter API
-    config = read_config()
-    api = get_app_auth_api(config)
+    session = get_session(session)
+    api = session.app_auth_pool
 
     # process Tweet id, storing returned Retweets in JSON format
     try:
@@ -69,30 +85,23 @@ def get_retweets(writer, tweet_id):
     # finished
     LOGGER.info("get_retweets() finished")
 
-def bulk_get_retweets(output_dir, tweet_ids):
+def bulk_get_retweets(output_dir, tweet_ids, workers=1, compression=None, shards=0):
     """Get hydrated Retweet-objects for a bulk of Tweet ids."""
     LOGGER.info("bulk_get_retweets() starting")
+    extension = get_compression_extension(compression)
+    function = partial(get_retweets, session=Session())
 
     # bulk process Tweet ids
-    num_processed = bulk_process(LOGGER, output_dir, "%d.json", get_retweets,
-                                 [(el, el) for el in tweet_ids], "tweet_id")
+    num_processed = bulk_process(LOGGER, output_dir, "%d.json" + extension, function,
+                                 ((el, el) for el in tweet_ids), "tweet_id",
+                                 workers=workers, shards=shards)
     if num_processed > 0:
         LOGGER.info("processed %d user ids", num_processed)
 
     # finished
     LOGGER.info("bulk_get_retweets() finished")
 
-def get_timeline(writer, user_id=None, screen_name=None, since_id=0):
-    """Get hydrated Tweet-objects from a user timeline."""
-    LOGGER.info("get_timeline() starting")
-    ensure_only_one(user_id=user_id, screen_name=screen_name)
-
-    # initialize config and Twitter API
-    config = read_config()
-    api = get_app_auth_api(config)
-
-    # process user id or screen name, storing returned Tweets in JSON format
-    num_tweets = 0
+def _write_timeline(writer, session, user_id=None, screen_name=None, since_id=0):
     args = {"count": TIMELINE_COUNT}
     if user_id is not None:
         args.update({"user_id": user_id})
@@ -100,9 +109,22 @@ def get_timeline(writer, user_id=None, screen_name=None, since_id=0):
         args.update({"screen_name": screen_name})
     if since_id > 0:
         args.update({"since_id": since_id})
-    limit = config.getint("timeline", "limit")
+    limit = session.config.getint("timeline", "limit")
+    return write_objs(writer, session.app_auth_pool.user_timeline, args, cursored=True,
+                      limit=limit)
+
+def get_timeline(writer, user_id=None, screen_name=None, since_id=0, session=None):
+    """Get hydrated Tweet-objects from a user timeline."""
+    LOGGER.info("get_timeline() starting")
+    ensure_only_one(user_id=user_id, screen_name=screen_name)
+
+    # initialize config and Twitter API
+    session = get_session(session)
+
+    # process user id or screen name, storing returned Tweets in JSON format
     try:
-        num_tweets = write_objs(writer, api.user_timeline, args, cursored=True, limit=limit)
+        num_tweets = _write_timeline(writer, session, user_id=user_id, screen_name=screen_name,
+                                     since_id=since_id)
         LOGGER.info("downloaded %d Tweet(s)", num_tweets)
     except TweepError as err:
         log_tweep_error(LOGGER, err)
@@ -110,37 +132,93 @@ def get_timeline(writer, user_id=None, screen_name=None, since_id=0):
     # finished
     LOGGER.info("get_timeline() finished")
 
-def bulk_get_timeline(output_dir, user_ids=None, screen_names=None):
+def bulk_get_timeline(output_dir, user_ids=None, screen_names=None, workers=1,  # pylint: disable=too-many-arguments
+                      compression=None, shards=0):
     """Get hydrated Tweet-objects from a bulk of user timelines."""
     LOGGER.info("bulk_get_timeline() starting")
     ensure_at_least_one(user_ids=user_ids, screen_names=screen_names)
+    extension = get_compression_extension(compression)
+    function = partial(get_timeline, session=Session())
 
     # bulk process user ids
     if user_ids:
-        num_processed = bulk_process(LOGGER, output_dir, "%d.txt", get_timeline,
-                                     [(el, el) for el in user_ids],
-                                     "user_id", resume=True)
+        num_processed = bulk_process(LOGGER, output_dir, "%d.txt" + extension, function,
+                                     ((el, el) for el in user_ids),
+                                     "user_id", resume=True, workers=workers, shards=shards)
         if num_processed > 0:
             LOGGER.info("processed %d user ids", num_processed)
 
     # bulk process screen names
     if screen_names:
-        num_processed = bulk_process(LOGGER, output_dir, "%s.txt", get_timeline,
-                                     [(el.lower(), el) for el in screen_names],
-                                     "screen_name", resume=True)
+        num_processed = bulk_process(LOGGER, output_dir, "%s.txt" + extension, function,
+                                     ((el.lower(), el) for el in screen_names),
+                                     "screen_name", resume=True, workers=workers,
+                                     shards=shards)
         if num_processed > 0:
             LOGGER.info("processed %d screen names", num_processed)
 
     # finished
     LOGGER.info("bulk_get_timeline() finished")
 
-def search(writer, query, since_id=0):
+class _SyncWriter(object):
+    """Writer that collects the ids of the written Tweets for the timeline sync state."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.ids = []
+        self._track_id = getattr(writer, "track_id", None)
+
+    def write(self, data):
+        """Write data to the underlying writer."""
+        self.writer.write(data)
+
+    def track_id(self, obj_id):
+        """Collect a written Tweet id."""
+        self.ids.append(obj_id)
+        if self._track_id is not None:
+            self._track_id(obj_id)
+
+def _sync_timeline(state, session, writer, user_id, since_id=0):
+    sync_writer = _SyncWriter(writer)
+    try:
+        num_tweets = _write_timeline(sync_writer, session, user_id=user_id,
+                                     since_id=max(since_id, state.get_since_id(user_id)))
+        LOGGER.info("synced %d new Tweet(s) of user %d", num_tweets, user_id)
+    except TweepError as err:
+        # a failed fetch says nothing about the user activity, so keep its schedule as is
+        log_tweep_error(LOGGER, err)
+        LOGGER.warning("sync of user %d failed, it stays due for the next run", user_id)
+        return
+    state.update(user_id, sync_writer.ids)
+
+def sync_timelines(output_dir, user_ids, workers=1, max_users=0, compression=None):
+    """Incrementally sync the timelines of a bulk of user ids that are due, most active first."""
+    LOGGER.info("sync_timelines() starting")
+    session = Session()
+    extension = get_compression_extension(compression)
+    if not path.exists(output_dir):
+        makedirs(output_dir)
+
+    # sync the due users, recording their new Tweets in the sync state index
+    with open_sync_state(session.config, output_dir) as state:
+        due_user_ids = state.gen_due_users(user_ids, max_users=max_users)
+        num_processed = bulk_process(LOGGER, output_dir, "%d.txt" + extension,
+                                     partial(_sync_timeline, state, session),
+                                     ((el, el) for el in due_user_ids),
+                                     "user_id", resume=True, workers=workers)
+        LOGGER.info("synced %d due user timeline(s)", num_processed)
+
+    # finished
+    LOGGER.info("sync_timelines() finished")
+
+def search(writer, query, since_id=0, session=None):
     """Get hydrated Tweet-objects using the Search API."""
     LOGGER.info("search() starting")
 
     # initialize config and Twitter API
-    config = read_config()
-    api = get_app_auth_api(config)
+    session = get_session(session)
+    config = session.config
+    api = session.app_auth_pool
 
     # process the query, storing returned Tweets in JSON format
     num_tweets = 0
@@ -162,13 +240,16 @@ def search(writer, query, since_id=0):
     # finished
     LOGGER.info("search() finished")
 
-def bulk_search(output_dir, queries):
+def bulk_search(output_dir, queries, workers=1, compression=None, shards=0):
     """Get hydrated Tweet-objects using a bulk of Search API queries."""
     LOGGER.info("bulk_search() starting")
+    extension = get_compression_extension(compression)
+    function = partial(search, session=Session())
 
     # bulk process queries
-    num_processed = bulk_process(LOGGER, output_dir, "%d.json", search,
-                                 enumerate(queries), "query", resume=True)
+    num_processed = bulk_process(LOGGER, output_dir, "%d.json" + extension, function,
+                                 enumerate(queries), "query", resume=True,
+                                 workers=workers, shards=shards)
     if num_processed > 0:
         LOGGER.info("processed %d queries", num_processed)
 
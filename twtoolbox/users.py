@@ -15,54 +15,90 @@
 
 """Twitter User-objects module."""
 
+import os
+import math
+import time
 import logging
+from array import array
+from functools import partial
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
+from os import path
 from tweepy import TweepError
-from .helpers import init_logger, read_config, get_app_auth_api, get_oauth_api
+from .helpers import init_logger, Session, get_session
 from .helpers import ensure_at_least_one, ensure_only_one, gen_chunks, bulk_process
-from .helpers import write_ids, write_objs, log_tweep_error
+from .helpers import write_ids, write_objs, log_tweep_error, read_checkpoint, write_checkpoint
+from .cache import open_cache
+from .ids import IdSet, open_binary_ids_writer, read_binary_ids
+from .writers import get_compression_extension, open_writer
 
 # module constants
 LOOKUP_USERS_PER_REQUEST = 100
 FOLLOWERS_IDS_COUNT = 5000
 FRIENDS_IDS_COUNT = 5000
 SEARCH_COUNT = 20
+SEARCH_MAX_RESULTS = 1000
+SEARCH_RESOURCE = "users/search"
+CRAWL_RELATIONS = ("followers", "friends")
+CRAWL_CHECKPOINT = "crawl"
+CRAWL_CHECKPOINT_INTERVAL = 300
 
 # module logging
 LOGGER = logging.getLogger(__name__)
 init_logger(LOGGER)
 
-def get_hydrated(writer, user_ids=None, screen_names=None):
+def _get_ids_output(binary=False, sort=False, compression=None):
+    if binary:
+        if compression is not None:
+            raise ValueError("ids in binary format can not be compressed")
+        return "ids", partial(open_binary_ids_writer, sort=sort)
+    return "txt" + get_compression_extension(compression), None
+
+def get_hydrated(writer, user_ids=None, screen_names=None, session=None):
     """Get hydrated Twitter User-objects from a list of user ids and/or screen names."""
     LOGGER.info("get_hydrated() starting")
     ensure_at_least_one(user_ids=user_ids, screen_names=screen_names)
     user_ids = user_ids if user_ids else []
     screen_names = screen_names if screen_names else []
 
-    # initialize config and Twitter API
-    config = read_config()
-    api = get_oauth_api(config)  # OAuth gives more capacity for the users/lookup API
+    # initialize config, Twitter API and hydration cache
+    session = get_session(session)
+    config = session.config
+    api = session.oauth_pool  # OAuth gives more capacity for the users/lookup API
+    cache = open_cache(config, "users")
 
-    # process user ids and/or screen names, storing returned users in JSON format
+    # process user ids and/or screen names not found in the cache, storing returned users in JSON
     num_users = 0
+    if cache is not None:
+        user_ids = cache.gen_misses(writer, user_ids)
+        screen_names = cache.gen_misses(writer, screen_names, by_screen_name=True)
     for chunk in gen_chunks(user_ids, screen_names, size=LOOKUP_USERS_PER_REQUEST):
         try:
             num_users += write_objs(writer, api.lookup_users,
-                                    {"user_ids": chunk[0], "screen_names": chunk[1]})
+                                    {"user_ids": chunk[0], "screen_names": chunk[1]},
+                                    callback=cache.put if cache is not None else None)
         except TweepError as err:
             log_tweep_error(LOGGER, err)
-    LOGGER.info("downloaded %d user(s)", num_users)
+    if cache is not None:
+        cache.close()
+        num_users += cache.num_hits
+        LOGGER.info("downloaded %d user(s), cache: %d hit(s), %d miss(es)",
+                    num_users, cache.num_hits, cache.num_misses)
+    else:
+        LOGGER.info("downloaded %d user(s)", num_users)
 
     # finished
     LOGGER.info("get_hydrated() finished")
 
-def get_followers(writer, user_id=None, screen_name=None):
+def get_followers(writer, user_id=None, screen_name=None, session=None):
     """Get the ids of the followers for a Twitter user id or screen name."""
     LOGGER.info("get_followers() starting")
     ensure_only_one(user_id=user_id, screen_name=screen_name)
 
     # initialize config and Twitter API
-    config = read_config()
-    api = get_app_auth_api(config)
+    session = get_session(session)
+    config = session.config
+    api = session.app_auth_pool
 
     # process user id or screen name, storing returned ids in plain text
     args = {"count": FOLLOWERS_IDS_COUNT}
@@ -80,36 +116,42 @@ def get_followers(writer, user_id=None, screen_name=None):
     # finished
     LOGGER.info("get_followers() finished")
 
-def bulk_get_followers(output_dir, user_ids=None, screen_names=None):
+def bulk_get_followers(output_dir, user_ids=None, screen_names=None, workers=1,  # pylint: disable=too-many-arguments
+                       binary=False, sort=False, compression=None, shards=0):
     """Get the ids of the followers for a bulk of Twitter user ids and/or screen names."""
     LOGGER.info("bulk_get_followers() starting")
     ensure_at_least_one(user_ids=user_ids, screen_names=screen_names)
     user_ids = user_ids if user_ids else []
     screen_names = screen_names if screen_names else []
+    extension, opener = _get_ids_output(binary, sort, compression)
+    function = partial(get_followers, session=Session())
 
     # bulk process user ids
-    num_processed = bulk_process(LOGGER, output_dir, "%d.txt", get_followers,
-                                 [(el, el) for el in user_ids], "user_id")
+    num_processed = bulk_process(LOGGER, output_dir, "%d." + extension, function,
+                                 ((el, el) for el in user_ids), "user_id",
+                                 workers=workers, opener=opener, shards=shards)
     if num_processed > 0:
         LOGGER.info("processed %d user ids", num_processed)
 
     # bulk process screen names
-    num_processed = bulk_process(LOGGER, output_dir, "%s.txt", get_followers,
-                                 [(el.lower(), el) for el in screen_names], "screen_name")
+    num_processed = bulk_process(LOGGER, output_dir, "%s." + extension, function,
+                                 ((el.lower(), el) for el in screen_names), "screen_name",
+                                 workers=workers, opener=opener, shards=shards)
     if num_processed > 0:
         LOGGER.info("processed %d screen names", num_processed)
 
     # finished
     LOGGER.info("bulk_get_followers() finished")
 
-def get_friends(writer, user_id=None, screen_name=None):
+def get_friends(writer, user_id=None, screen_name=None, session=None):
     """Get the ids of the friends for a Twitter user id or screen name."""
     LOGGER.info("get_friends() starting")
     ensure_only_one(user_id=user_id, screen_name=screen_name)
 
     # initialize config and Twitter API
-    config = read_config()
-    api = get_app_auth_api(config)
+    session = get_session(session)
+    config = session.config
+    api = session.app_auth_pool
 
     # process user id or screen name, storing returned ids in plain text
     args = {"count": FRIENDS_IDS_COUNT}
@@ -127,46 +169,84 @@ def get_friends(writer, user_id=None, screen_name=None):
     # finished
     LOGGER.info("get_friends() finished")
 
-def bulk_get_friends(output_dir, user_ids=None, screen_names=None):
+def bulk_get_friends(output_dir, user_ids=None, screen_names=None, workers=1,  # pylint: disable=too-many-arguments
+                     binary=False, sort=False, compression=None, shards=0):
     """Get the ids of the friends for a bulk of Twitter user ids and/or screen names."""
     LOGGER.info("bulk_get_friends() starting")
     ensure_at_least_one(user_ids=user_ids, screen_names=screen_names)
     user_ids = user_ids if user_ids else []
     screen_names = screen_names if screen_names else []
+    extension, opener = _get_ids_output(binary, sort, compression)
+    function = partial(get_friends, session=Session())
 
     # bulk process user ids
-    num_processed = bulk_process(LOGGER, output_dir, "%d.txt", get_friends,
-                                 [(el, el) for el in user_ids], "user_id")
+    num_processed = bulk_process(LOGGER, output_dir, "%d." + extension, function,
+                                 ((el, el) for el in user_ids), "user_id",
+                                 workers=workers, opener=opener, shards=shards)
     if num_processed > 0:
         LOGGER.info("processed %d user ids", num_processed)
 
     # bulk process screen names
-    num_processed = bulk_process(LOGGER, output_dir, "%s.txt", get_friends,
-                                 [(el.lower(), el) for el in screen_names], "screen_name")
+    num_processed = bulk_process(LOGGER, output_dir, "%s." + extension, function,
+                                 ((el.lower(), el) for el in screen_names), "screen_name",
+                                 workers=workers, opener=opener, shards=shards)
     if num_processed > 0:
         LOGGER.info("processed %d screen names", num_processed)
 
     # finished
     LOGGER.info("bulk_get_friends() finished")
 
-def search(writer, query):
+def _get_search_page(api, query, page):
+    return api.search_users(q=query, count=SEARCH_COUNT, page=page)
+
+def _gen_search_pages(api, query, num_pages, concurrency=1):
+    # pages are numbered (not cursor-chained), so fetch as many at once as the budget allows
+    pool = ThreadPool(concurrency) if concurrency > 1 else None
+    try:
+        page = 1
+        while page <= num_pages:
+            remaining = api.get_budgets().get(SEARCH_RESOURCE, {}).get("remaining")
+            size = min(concurrency, num_pages - page + 1,
+                       max(remaining, 1) if remaining is not None else concurrency)
+            fetch = partial(_get_search_page, api, query)
+            pages = range(page, page + size)
+            for users in pool.map(fetch, pages) if size > 1 else [fetch(el) for el in pages]:
+                yield users
+                if len(users) < SEARCH_COUNT:
+                    return  # last page of results
+            page += size
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def _gen_unique_users(pages, limit=0):
+    # the same user can be returned in several pages
+    seen_ids = set()
+    for users in pages:
+        for user in users:
+            if user.id not in seen_ids:
+                seen_ids.add(user.id)
+                yield user
+                if 0 < limit <= len(seen_ids):
+                    return
+
+def search(writer, query, session=None):
     """Get hydrated Twitter User-objects using the People Search API."""
     LOGGER.info("search() starting")
 
     # initialize config and Twitter API
-    config = read_config()
-    api = get_oauth_api(config)  # only OAuth supported for the users/search API
+    session = get_session(session)
+    config = session.config
+    api = session.oauth_pool  # only OAuth supported for the users/search API
 
-    # process the query, storing returned users in JSON format
+    # process the query, storing returned unique users in JSON format
     num_users = 0
-    search_params = {
-        "q": query,
-        "count": SEARCH_COUNT,
-    }
     limit = config.getint("search_users", "limit")
+    num_pages = int(math.ceil(float(min(limit or SEARCH_MAX_RESULTS, SEARCH_MAX_RESULTS)) /
+                              SEARCH_COUNT))
+    pages = _gen_search_pages(api, query, num_pages, config.getint("search_users", "concurrency"))
     try:
-        num_users = write_objs(writer, api.search_users, search_params,
-                               cursored=True, limit=limit)
+        num_users = write_objs(writer, _gen_unique_users, {"pages": pages, "limit": limit})
         LOGGER.info("downloaded %d user(s)", num_users)
     except TweepError as err:
         log_tweep_error(LOGGER, err)
@@ -174,15 +254,165 @@ def search(writer, query):
     # finished
     LOGGER.info("search() finished")
 
-def bulk_search(output_dir, queries):
+def bulk_search(output_dir, queries, workers=1, compression=None, shards=0):
     """Get hydrated Twitter User-objects using a bulk of People Search API queries."""
     LOGGER.info("bulk_search() starting")
+    extension = get_compression_extension(compression)
+    function = partial(search, session=Session())
 
     # bulk process queries
-    num_processed = bulk_process(LOGGER, output_dir, "%d.json", search,
-                                 enumerate(queries), "query")
+    num_processed = bulk_process(LOGGER, output_dir, "%d.json" + extension, function,
+                                 enumerate(queries), "query",
+                                 workers=workers, shards=shards)
     if num_processed > 0:
         LOGGER.info("processed %d queries", num_processed)
 
     # finished
     LOGGER.info("bulk_search() finished")
+
+class _CrawlWriter(object):
+    """Writer of ids that also collects them (up to a maximum) for expanding a crawl."""
+
+    def __init__(self, writer, max_ids=0):
+        self.writer = writer
+        self.max_ids = max_ids
+        self.ids = array("Q")
+        self._write_id = getattr(writer, "write_id", None)
+
+    def write_id(self, _id):
+        """Write a Twitter id and collect it."""
+        if self._write_id is not None:
+            self._write_id(_id)
+        else:
+            self.writer.write("%d\n" % _id)
+        if not self.max_ids or len(self.ids) < self.max_ids:
+            self.ids.append(_id)
+
+class _CrawlState(object):
+    """Resumable state of a crawl: visited users, current and next frontier."""
+
+    def __init__(self, output_dir, frontier):
+        self.output_dir = output_dir
+        self.frontier = frontier
+        self.next = array("Q")
+        self.queued = IdSet()
+        self.visited = IdSet()
+        self.level = 0
+        self.position = 0
+        self.generation = 0
+        self.finished = False
+
+    def _get_filename(self, generation, name):
+        return path.join(self.output_dir, "%s-%d.%s" % (CRAWL_CHECKPOINT, generation, name))
+
+    def load(self):
+        """Load the last checkpoint of the crawl, returning False if there is none."""
+        checkpoint = read_checkpoint(path.join(self.output_dir, CRAWL_CHECKPOINT))
+        if checkpoint is None:
+            return False
+        self.level, self.position = checkpoint["level"], checkpoint["position"]
+        self.generation, self.finished = checkpoint["generation"], checkpoint["finished"]
+        self.frontier = array("Q", read_binary_ids(self._get_filename(self.generation, "frontier")))
+        self.next = array("Q", read_binary_ids(self._get_filename(self.generation, "next")))
+        self.queued = IdSet(self.next)
+        self.visited = IdSet()
+        self.visited.ids = array("Q", read_binary_ids(self._get_filename(self.generation, "visited")))
+        return True
+
+    def save(self):
+        """Checkpoint the crawl, replacing the previous checkpoint atomically."""
+        generation = self.generation + 1
+        for name, ids in (("frontier", self.frontier), ("next", self.next),
+                          ("visited", self.visited.get_sorted_ids())):
+            with open_binary_ids_writer(self._get_filename(generation, name)) as writer:
+                writer.write_ids(ids)
+        write_checkpoint(path.join(self.output_dir, CRAWL_CHECKPOINT), {
+            "generation": generation, "level": self.level, "position": self.position,
+            "finished": self.finished})
+        for name in ("frontier", "next", "visited"):
+            if path.exists(self._get_filename(self.generation, name)):
+                os.remove(self._get_filename(self.generation, name))
+        self.generation = generation
+
+    def enqueue(self, ids, priority=False):
+        """Add discovered ids to the next frontier, each only once unless ranking by priority."""
+        for _id in ids:
+            if _id in self.visited:
+                continue
+            if not priority:
+                if _id in self.queued:
+                    continue
+                self.queued.add(_id)
+            self.next.append(_id)
+
+    def advance(self, priority=False):
+        """Advance the crawl to the next depth level, ordering the next frontier if needed."""
+        if priority:
+            # most discovered users first, i.e. with most connections to the visited users
+            counts = ((-len(list(group)), _id) for _id, group in groupby(sorted(self.next)))
+            self.next = array("Q", (_id for _, _id in sorted(counts)))
+        self.frontier, self.next = self.next, array("Q")
+        self.queued = IdSet()
+        self.level += 1
+        self.position = 0
+
+def _is_crawl_full(state, max_users):
+    return max_users > 0 and len(state.visited) >= max_users
+
+def crawl(output_dir, user_ids, relations=("followers",), depth=1, max_expand=0,  # pylint: disable=too-many-arguments,too-many-locals
+          max_users=0, priority=False, binary=False, compression=None):
+    """Crawl the followers and/or friends graph from seed Twitter user ids up to a given depth."""
+    LOGGER.info("crawl() starting")
+    for relation in relations:
+        if relation not in CRAWL_RELATIONS:
+            raise ValueError("unknown crawl relation: %s" % relation)
+    session = Session()
+    functions = {"followers": get_followers, "friends": get_friends}
+    extension, opener = _get_ids_output(binary, compression=compression)
+    opener = opener if opener is not None else open_writer
+    for relation in relations:
+        if not path.exists(path.join(output_dir, relation)):
+            os.makedirs(path.join(output_dir, relation))
+
+    # start from the seed users or resume from the last checkpoint
+    state = _CrawlState(output_dir, array("Q", user_ids))
+    if state.load():
+        if state.finished:
+            LOGGER.info("crawl already finished")
+            return
+        LOGGER.info("resuming crawl at depth %d: %d user(s) visited, %d in the frontier",
+                    state.level, len(state.visited), len(state.frontier) - state.position)
+
+    # expand the frontier level by level, checkpointing periodically and on exit
+    checkpointed = time.time()
+    try:
+        while state.level < depth and not _is_crawl_full(state, max_users):
+            while state.position < len(state.frontier) and not _is_crawl_full(state, max_users):
+                user_id = state.frontier[state.position]
+                if user_id not in state.visited:
+                    discovered = []
+                    for relation in relations:
+                        filename = path.join(output_dir, relation, "%d.%s" % (user_id, extension))
+                        with opener(filename) as writer:
+                            crawl_writer = _CrawlWriter(writer, max_expand)
+                            functions[relation](crawl_writer, user_id=user_id, session=session)
+                            discovered.append(crawl_writer.ids)
+                    if state.level + 1 < depth:
+                        for ids in discovered:
+                            state.enqueue(ids, priority)
+                    state.visited.add(user_id)
+                state.position += 1
+                if time.time() - checkpointed >= CRAWL_CHECKPOINT_INTERVAL:
+                    state.save()
+                    checkpointed = time.time()
+            if state.position >= len(state.frontier):
+                state.advance(priority)
+                LOGGER.info("crawl reached depth %d: %d user(s) visited, %d in the frontier",
+                            state.level, len(state.visited), len(state.frontier))
+        state.finished = True
+    finally:
+        state.save()
+    LOGGER.info("crawled %d user(s)", len(state.visited))
+
+    # finished
+    LOGGER.info("crawl() finished")
@@ -0,0 +1,365 @@
+# Twitter Toolbox for Python
+# Copyright 2016 Hugo Hromic
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compressed and rotating output writers module."""
+
+import io
+import os
+import gzip
+import zlib
+import time
+from threading import Thread, Event, Lock
+from os import path
+from os import replace as replace_file
+
+# module constants
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+FLUSH_INTERVAL = 5
+SYNC_INTERVAL = 1
+SYNC_RECORDS = 1000
+TAIL_BLOCK_SIZE = 64 * 1024
+
+def get_compression(filename):
+    """Get the compression of a file according to its extension (None if not compressed)."""
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+    return None
+
+def get_compression_extension(compression):
+    """Get the filename extension for a compression (empty if no compression)."""
+    if compression is None:
+        return ""
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError("unknown compression: %s" % compression)
+    return COMPRESSION_EXTENSIONS[compression]
+
+def _ensure_zstandard():
+    # imported on first use, so writing uncompressed or gzip outputs does not load it
+    try:
+        import zstandard  # pylint: disable=import-error
+    except ImportError:
+        raise ValueError("zstd compression requires the 'zstandard' package") from None
+    return zstandard
+
+def compress_data(data, compression):
+    """Compress bytes as a complete gzip member or zstd frame (None for no compression).
+
+    Compressed chunks can be concatenated and still form a valid compressed stream."""
+    if compression is None:
+        return data
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        return _ensure_zstandard().ZstdCompressor().compress(data)
+    raise ValueError("unknown compression: %s" % compression)
+
+class CompressedWriter(object):
+    """Text writer that compresses data, flushing it periodically for streaming usage."""
+
+    def __init__(self, filename, compression, append=False, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._file = None
+        mode = "ab" if append else "wb"
+        if compression == "gzip":
+            self._writer = gzip.open(filename, mode)
+        elif compression == "zstd":
+            compressor = _ensure_zstandard().ZstdCompressor()
+            self._file = open(filename, mode)
+            self._writer = compressor.stream_writer(self._file)
+        else:
+            raise ValueError("unknown compression: %s" % compression)
+        self._last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        """Compress and write text data, flushing the compressed stream if it is time to."""
+        self._writer.write(data.encode("utf-8"))
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Flush the compressed stream so all the data written so far can be decompressed."""
+        self._writer.flush()
+        if self._file is not None:
+            self._file.flush()
+        self._last_flush = time.time()
+
+    def fileno(self):
+        """Get the file descriptor of the underlying file."""
+        if self._file is not None:
+            return self._file.fileno()
+        return self._writer.fileno()
+
+    def close(self):
+        """Finish the compressed stream and close the file."""
+        self._writer.close()
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+class DurableWriter(object):
+    """Text writer that group-commits data, syncing batches of records to disk together.
+
+    Writes are batched in memory and the batch is written, flushed and fsync()ed once it holds
+    a number of records or is older than an interval, instead of syncing every record.
+    A background thread commits the batch when the interval expires with no new writes."""
+
+    def __init__(self, writer, sync_interval=SYNC_INTERVAL, sync_records=SYNC_RECORDS):
+        self.writer = writer
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self._batch = []
+        self._num_pending = 0
+        self._last_sync = time.time()
+        self._error = None
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        if sync_interval > 0:
+            self._thread = Thread(target=self._run_syncer, name="durable-writer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run_syncer(self):
+        delay = self.sync_interval
+        while not self._stopped.wait(delay):
+            with self._lock:
+                delay = self._last_sync + self.sync_interval - time.time()
+                if delay > 0:
+                    continue
+                delay = self.sync_interval
+                if self._batch:
+                    try:
+                        self._sync()
+                    except Exception as excp:  # pylint: disable=broad-except
+                        self._error = excp  # raised on the next write or when closing
+                        return
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _sync(self):
+        if self._batch:
+            self.writer.write("".join(self._batch))
+            self._batch = []
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self._num_pending = 0
+        self._last_sync = time.time()
+
+    def write(self, data):
+        """Add text data to the batch, committing the batch if it is time to."""
+        with self._lock:
+            self._check_error()
+            self._batch.append(data)
+            self._num_pending += data.count("\n")
+            if self._num_pending >= self.sync_records or \
+               time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        """Write the batch and sync it to disk."""
+        with self._lock:
+            self._check_error()
+            self._sync()
+
+    def flush(self):
+        """Commit the batch, so all the data written so far is durable."""
+        self.sync()
+
+    def fileno(self):
+        """Get the file descriptor of the underlying writer."""
+        return self.writer.fileno()
+
+    def close(self):
+        """Stop the background commits, commit the batch and close the underlying writer."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.sync()
+        finally:
+            self.writer.close()
+
+def open_writer(filename, append=False, compression=None, durable=False,  # pylint: disable=too-many-arguments
+                sync_interval=SYNC_INTERVAL, sync_records=SYNC_RECORDS):
+    """Open a text writer for a file, compressed according to its extension if not given.
+
+    In durable mode, records are group-committed to disk (see DurableWriter)."""
+    compression = compression if compression is not None else get_compression(filename)
+    if compression is None:
+        writer = open(filename, "a" if append else "w")
+    else:
+        writer = CompressedWriter(filename, compression, append=append)
+    if durable:
+        return DurableWriter(writer, sync_interval=sync_interval, sync_records=sync_records)
+    return writer
+
+def open_reader(filename):
+    """Open a binary reader for a file, decompressed according to its extension."""
+    compression = get_compression(filename)
+    if compression == "gzip":
+        return gzip.open(filename, "rb")
+    if compression == "zstd":
+        return io.BufferedReader(_ensure_zstandard().ZstdDecompressor().stream_reader(
+            open(filename, "rb"), read_across_frames=True))
+    return open(filename, "rb")
+
+def _truncate_plain_tail(filename):
+    # scan backwards for the end of the last complete record and cut everything after it
+    with open(filename, "r+b") as writer:
+        size = writer.seek(0, io.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - TAIL_BLOCK_SIZE)
+            writer.seek(start)
+            newline = writer.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            writer.truncate(end)
+    return end < size
+
+def _has_unterminated_frame(filename):
+    # zstd frames can not be continued after a crash, check that the last one was ended
+    decompressor = _ensure_zstandard().ZstdDecompressor()
+    decompressobj, in_frame = decompressor.decompressobj(), False
+    with open(filename, "rb") as reader:
+        for chunk in iter(lambda: reader.read(TAIL_BLOCK_SIZE), b""):
+            while chunk:
+                decompressobj.decompress(chunk)
+                in_frame = True
+                chunk = b""
+                if decompressobj.eof:
+                    chunk = decompressobj.unused_data
+                    decompressobj, in_frame = decompressor.decompressobj(), False
+    return in_frame
+
+def _truncate_compressed_tail(filename, compression):
+    # compressed streams can not be cut, so rewrite the complete records if the tail is torn
+    valid_size, torn = 0, False
+    errors = (EOFError, IOError, OSError, zlib.error)
+    if compression == "zstd":
+        errors += (_ensure_zstandard().ZstdError,)
+    try:
+        with open_reader(filename) as reader:
+            for line in reader:
+                if not line.endswith(b"\n"):
+                    torn = True
+                    break
+                valid_size += len(line)
+    except errors:
+        torn = True
+    if compression == "zstd" and not torn:
+        torn = _has_unterminated_frame(filename)
+    if not torn:
+        return False
+    with open_reader(filename) as reader, \
+            CompressedWriter(filename + ".tmp", compression) as writer:
+        while valid_size > 0:
+            line = reader.readline()
+            writer.write(line.decode("utf-8"))
+            valid_size -= len(line)
+    replace_file(filename + ".tmp", filename)
+    return True
+
+def truncate_torn_tail(filename):
+    """Truncate a torn (incomplete) trailing record left in a file by a crash.
+
+    Returns whether a torn record was found and truncated."""
+    compression = get_compression(filename)
+    if compression is None:
+        return _truncate_plain_tail(filename)
+    if compression == "zstd":
+        _ensure_zstandard()
+    return _truncate_compressed_tail(filename, compression)
+
+class RotatingWriter(object):
+    """Text writer that rotates its output file by size and/or wall-clock time interval.
+
+    The filename pattern can include strftime() directives, which are expanded using the
+    local time at which each file is opened. Time intervals are aligned to the clock.
+    Extra keyword arguments are passed to open_writer(), e.g. to enable the durable mode."""
+
+    def __init__(self, pattern, max_size=0, interval=0, compression=None, **kwargs):
+        self.pattern = pattern
+        self.max_size = max_size
+        self.interval = interval
+        self.compression = compression
+        self.writer_options = kwargs
+        self.filename = None
+        self._writer = None
+        self._size = 0
+        self._next_rotation = None
+        self._rotate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_filename(self):
+        filename = time.strftime(self.pattern)
+        if filename != self.filename and not path.exists(filename):
+            return filename
+        dirname, basename = path.split(filename)
+        root, dot, extension = basename.partition(".")
+        counter = 1
+        while True:
+            candidate = path.join(dirname, "%s-%d%s%s" % (root, counter, dot, extension))
+            if not path.exists(candidate):
+                return candidate
+            counter += 1
+
+    def _rotate(self):
+        if self._writer is not None:
+            self._writer.close()
+        self.filename = self._get_filename()
+        self._writer = open_writer(self.filename, compression=self.compression,
+                                   **self.writer_options)
+        self._size = 0
+        if self.interval > 0:
+            self._next_rotation = (time.time() // self.interval + 1) * self.interval
+
+    def write(self, data):
+        """Write text data, rotating the output file first if needed."""
+        if (self.max_size > 0 and self._size >= self.max_size) or \
+           (self._next_rotation is not None and time.time() >= self._next_rotation):
+            self._rotate()
+        self._writer.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        """Flush the current output file."""
+        self._writer.flush()
+
+    def close(self):
+        """Close the current output file."""
+        self._writer.close()